@@ -7,11 +7,11 @@ settings_path = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[
 settings = imp.load_source('settings', os.path.join( settings_path,  'settings.py'))
 setup_environ(settings)
 from django.db import transaction, connections
-from django.db import IntegrityError, DatabaseError
 from daemon import Daemon
 from generic import *
 import logging
 from middleware import ConnectionMiddleware
+from pool import sphinx_connection
 
 class QueueDaemon(Daemon):
   '''
@@ -38,28 +38,29 @@ class QueueDaemon(Daemon):
     replace = re.compile(r'^INSERT\s+')
     while(True):
       for index_id, index in indexes.iteritems():
-        m = connections['sphinx:' + str(index_id)].cursor()
         keys = r.lrange('queue:' + str(index_id), 0, -1)
         if keys:
-          for key in keys:
-            data = r.get(key)
-            data = marshal.loads(data) 
-            self.Logger.info('Applying key ' + key)
-            action = key.split(':')[0]
-            try:
-              m.executemany(data['sql'], data['values'])
-            except IntegrityError as e:
-              pass
-            except DatabaseError as e:
-              if action == 'insert':
-                m.executemany(replace.sub('REPLACE ', data['sql']), data['values'])
-              else:
-                pass            
-            p = r.pipeline()
-            p.lpop('queue:' + str(index_id))
-            p.delete(key)
-            p.hset(index + ':last-modified', action, int(time.time()*10**6))
-            p.execute()            
+          with sphinx_connection(index_id) as c:
+            m = c.cursor()
+            for key in keys:
+              data = r.get(key)
+              data = marshal.loads(data) 
+              self.Logger.info('Applying key ' + key)
+              action = key.split(':')[0]
+              try:
+                m.executemany(data['sql'], data['values'])
+              except MySQLdb.IntegrityError as e:
+                pass
+              except MySQLdb.DatabaseError as e:
+                if action == 'insert':
+                  m.executemany(replace.sub('REPLACE ', data['sql']), data['values'])
+                else:
+                  pass            
+              p = r.pipeline()
+              p.lpop('queue:' + str(index_id))
+              p.delete(key)
+              p.hset(index + ':last-modified', action, int(time.time()*10**6))
+              p.execute()            
       time.sleep(0.001) #sleep for 1ms
 
 if __name__ == '__main__':
@@ -1,12 +1,202 @@
 from generic import *
+from stats import stats, SIZE_BUCKETS
+from collections import OrderedDict
+import os
 import time
+import math
 import marshal
+import zlib
+import threading
+
+INVALIDATE_CHANNEL = 'cache:invalidate'
+
+class CacheLockTimeout(Exception):
+  pass
+
+''' Codec header byte of serialized entries, entries without one are plain marshal '''
+CODEC_MARSHAL = '\x00'
+CODEC_ZLIB = '\x01'
+
+def dumps(value):
+  ''' Serialize a cache entry, compressing it with zlib above CACHE_COMPRESS_THRESHOLD bytes '''
+  data = marshal.dumps(value)
+  if settings.CACHE_COMPRESS_THRESHOLD > 0 and len(data) > settings.CACHE_COMPRESS_THRESHOLD:
+    compressed = zlib.compress(data, settings.CACHE_COMPRESS_LEVEL)
+    if len(compressed) < len(data):
+      return CODEC_ZLIB + compressed
+  return CODEC_MARSHAL + data
+
+def loads(data):
+  ''' Unserialize a cache entry written by dumps() (or a plain marshal entry of older releases) '''
+  codec = data[:1]
+  if codec == CODEC_ZLIB:
+    return marshal.loads(zlib.decompress(data[1:]))
+  if codec == CODEC_MARSHAL:
+    return marshal.loads(data[1:])
+  ''' marshal type codes are printable characters, never a codec byte '''
+  return marshal.loads(data)
+
+''' 
+Resolve the version of an index and fetch entries of that version in one call.
+KEYS[1] version key, ARGV[1] index id, ARGV[2] lock key ('' for none), ARGV[3..] key prefixes.
+Returns { version, lock held (0/1), entry, ... }, missing version / entries are nil.
+'''
+LOOKUP_SCRIPT = '''
+local version = redis.call('GET', KEYS[1])
+local suffix = ':' .. ARGV[1] .. ':' .. (version or 'None')
+local reply = { version, 0 }
+if ARGV[2] ~= '' then
+  reply[2] = redis.call('EXISTS', ARGV[2])
+end
+for n = 3, #ARGV do
+  reply[n] = redis.call('GET', ARGV[n] .. suffix)
+end
+return reply
+'''
+lookup_script = None
+
+'''
+Release a re-caching lock only if it still holds the token of the caller and wake up
+the waiters of that holder. KEYS[1] lock key, KEYS[2] notify list of the token,
+ARGV[1] token, ARGV[2] expiry of the notify list in milliseconds.
+'''
+RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('DEL', KEYS[1])
+end
+redis.call('RPUSH', KEYS[2], 1)
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 1
+'''
+
+def key_version(key):
+  ''' (index_id, version) embedded in a cache key (cache:<type>:<hash>:<index_id>:<version>) or None '''
+  try:
+    index_id, version = key.rsplit(':', 2)[-2:]
+    return (int(index_id), version)
+  except:
+    return None
+
+class LocalCache:
+  '''
+  In-process L1 cache in front of Redis.
+  A bounded (in bytes) LRU of serialized "cache:*" entries. 
+  Index versions are kept in-process as well and are pushed by Cache.dirty()
+  through the INVALIDATE_CHANNEL Pub/Sub channel, so that hot entries are
+  served without any Redis round trip. Entries of an index are evicted as soon
+  as a new version of the index is announced; the keys of every index are tracked
+  so that only the entries of that index are visited.
+  '''
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.entries = OrderedDict()
+    self.indexes = {}
+    self.versions = {}
+    self.lock = threading.Lock()
+    self.pid = None
+
+  def _index(self, key):
+    ''' Index id embedded in a cache key '''
+    embedded = key_version(key)
+    if embedded is None:
+      return None
+    return embedded[0]
+
+  def _discard(self, key):
+    value, expires = self.entries.pop(key)
+    self.size -= len(value)
+    index_id = self._index(key)
+    keys = self.indexes.get(index_id)
+    if not keys is None:
+      keys.discard(key)
+      if not keys:
+        del self.indexes[index_id]
+
+  def get(self, key):
+    now = time.time()
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      if entry[1] < now:
+        self._discard(key)
+        return None
+      del self.entries[key]
+      self.entries[key] = entry
+      return entry[0]
+
+  def set(self, key, value, expire):
+    ''' value is the serialized entry, expire in seconds '''
+    if len(value) > self.max_bytes:
+      return
+    with self.lock:
+      if key in self.entries:
+        self._discard(key)
+      self.entries[key] = (value, time.time() + expire)
+      self.size += len(value)
+      index_id = self._index(key)
+      if not index_id is None:
+        self.indexes.setdefault(index_id, set()).add(key)
+      while self.size > self.max_bytes:
+        self._discard(next(iter(self.entries)))
+
+  def version(self, index_id):
+    ''' 
+    In-process (version, time checked) of an index, 
+    None if unknown or older than L1_CACHE_VERSION_TTL 
+    '''
+    self.subscribe()
+    entry = self.versions.get(index_id)
+    if entry is None or (time.time() - entry[1]) > settings.L1_CACHE_VERSION_TTL:
+      return None
+    return entry
+
+  def set_version(self, index_id, version):
+    ''' Record the current version of an index and evict entries of any other version '''
+    with self.lock:
+      previous = self.versions.get(index_id)
+      self.versions[index_id] = (version, time.time())
+      if previous is None or previous[0] == version:
+        return
+      for key in list(self.indexes.get(index_id, ())):
+        if key.split(':')[-1] != str(version):
+          self._discard(key)
+
+  def subscribe(self):
+    ''' Start the invalidation listener once per process (again after a fork) '''
+    if self.pid == os.getpid():
+      return
+    self.pid = os.getpid()
+    self.versions = {}
+    listener = threading.Thread(target = self.listen)
+    listener.daemon = True
+    listener.start()
+
+  def listen(self):
+    while True:
+      try:
+        pubsub = redis26().pubsub()
+        pubsub.subscribe(INVALIDATE_CHANNEL)
+        for message in pubsub.listen():
+          if message['type'] != 'message':
+            continue
+          index_id, version = message['data'].split(':')
+          self.set_version(int(index_id), version)
+      except:
+        ''' versions can not be trusted while disconnected '''
+        self.versions = {}
+        time.sleep(1)
+
+local = LocalCache(settings.L1_CACHE_MAX_BYTES)
 
 class Cache:
   R = None
 
   def __init__(self):
     self.R = redis26()
+    ''' tokens of the locks held by this session '''
+    self.locks = {}
   
   def __delete(self, keys, expires = 500):
     ''' Set key expiration at specified time in milliseconds  '''
@@ -27,17 +217,102 @@ class Cache:
       return False
     return True
 
+  def _track(self, p, key, expire):
+    '''
+    Queue the registration of a result entry in the key set of its index version
+    (keys:<index_id>:<version>) on pipeline p, so that invalidate() never scans the keyspace.
+    The set expires along with the entries, expire in seconds.
+    '''
+    if not key.startswith('cache:'):
+      return
+    embedded = key_version(key)
+    if embedded is None:
+      return
+    keyset = 'keys:%d:%s' % embedded
+    p.sadd(keyset, key)
+    if expire > 0:
+      p.pexpire(keyset, int(expire * 10**3))
+    else:
+      p.persist(keyset)
+
+  def _local(self, key):
+    ''' Only result entries are kept in the in-process L1 cache '''
+    return settings.L1_CACHE and key.startswith('cache:')
+
   def get(self, key, unserialize = True):
+    value = None
+    if self._local(key):
+      value = local.get(key)
+    if value is None:
+      value = self.R.get(key)
+      if not value is None and self._local(key):
+        local.set(key, value, settings.L1_CACHE_EXPIRE)
+    if unserialize and not value is None:
+      return loads(value)
+    return value
+
+  def lookup(self, index_id, prefixes, lock_key = None):
+    '''
+    Resolve the current version of an index and fetch the entries of that version
+    (<prefix>:<index_id>:<version>) in a single round trip (EVALSHA of LOOKUP_SCRIPT).
+    Returns (version, cache keys, values, lock state), missing entries are None.
+    The lock state tells whether lock_key is held and is None when it was not checked.
+    With L1 enabled and a recent in-process version no script is run at all.
+    '''
+    global lookup_script
+    if settings.L1_CACHE:
+      entry = local.version(index_id)
+      if not entry is None:
+        keys = [ '%s:%d:%s' % (prefix, index_id, entry[0]) for prefix in prefixes ]
+        values = self.mget(keys)
+        self.__hits(index_id, values)
+        return (entry[0], keys, values, None)
+    if lookup_script is None:
+      lookup_script = self.R.register_script(LOOKUP_SCRIPT)
+    reply = lookup_script(keys = [ 'version:%d' % (index_id,) ],
+                          args = [ index_id, lock_key or '' ] + list(prefixes), client = self.R)
+    version = reply[0]
+    keys = [ '%s:%d:%s' % (prefix, index_id, version) for prefix in prefixes ]
+    values = list(reply[2:]) + [ None ] * (len(keys) - len(reply[2:]))
+    if settings.L1_CACHE:
+      local.set_version(index_id, version)
+      for key, value in zip(keys, values):
+        if not value is None:
+          local.set(key, value, settings.L1_CACHE_EXPIRE)
+    values = [ None if value is None else loads(value) for value in values ]
+    self.__hits(index_id, values)
+    locked = bool(reply[1]) if lock_key else None
+    return (version, keys, values, locked)
+
+  def __hits(self, index_id, values):
+    misses = values.count(None)
+    stats.incr('cache_hits', index_id, len(values) - misses)
+    stats.incr('cache_misses', index_id, misses)
+
+  def __stored(self, key, value):
+    ''' Size of a stored result entry '''
+    embedded = key_version(key)
+    if not embedded is None:
+      stats.observe('entry_bytes', embedded[0], len(value), SIZE_BUCKETS)
+
+  def mget(self, keys, unserialize = True):
+    ''' Fetch several keys in one round trip, missing keys are returned as None '''
+    values = [ local.get(key) if self._local(key) else None for key in keys ]
+    misses = [ n for n, value in enumerate(values) if value is None ]
+    if misses:
+      for n, value in zip(misses, self.R.mget([ keys[n] for n in misses ])):
+        values[n] = value
+        if not value is None and self._local(keys[n]):
+          local.set(keys[n], value, settings.L1_CACHE_EXPIRE)
     if unserialize:
-      return marshal.loads(self.R.get(key))
-    else:
-      return self.R.get(key)
+      values = [ None if value is None else loads(value) for value in values ]
+    return values
 
   def set(self, key, value, watch = False, expire = 0., lock = None, keylist = None):
     ''' expire parameter is float -> multiplied by 10**3 and passed to pexpire '''
     try:
       cache_time = int(time.time() * 10**6)
-      marshal.dumps(value)
+      value = dumps(value)
       p = self.R.pipeline()      
       if watch:
         p.watch(key)
@@ -46,34 +321,203 @@ class Cache:
         p.rpush(keylist, key)
       if expire > 0:
         p.pexpire(key, int(expire * 10**3))
+      self._track(p, key, expire)
       if not lock is None:
-        p.delete(lock)
+        self.__release(p, lock)
       p.execute()
+      self.__stored(key, value)
+      if self._local(key):
+        local.set(key, value, expire if expire > 0 else settings.L1_CACHE_EXPIRE)
       return True
     except:
       return False
 
-  def invalidate(self, index_id, version):
-    version_pattern = '*:%d:%s' % (index_id, version)
+  def mset(self, values, expire = 0., lock = None):
+    ''' Store several entries in one round trip, expire in seconds, releasing lock if given '''
+    try:
+      p = self.R.pipeline(transaction = False)
+      for key, value in values.iteritems():
+        value = dumps(value)
+        if expire > 0:
+          p.psetex(key, int(expire * 10**3), value)
+        else:
+          p.set(key, value)
+        self._track(p, key, expire)
+        self.__stored(key, value)
+        if self._local(key):
+          local.set(key, value, expire if expire > 0 else settings.L1_CACHE_EXPIRE)
+      if not lock is None:
+        self.__release(p, lock)
+      p.execute()
+      return True
+    except:
+      return False
+
+  def lock(self, lock_key, timeout):
+    ''' 
+    Atomically acquire a re-caching lock (SET NX with expiry in seconds).
+    The lock holds a random token of its holder, so that a holder whose lock expired
+    never releases the lock of the next one. Returns True if this session holds the lock.
+    '''
+    token = os.urandom(16).encode('hex')
+    if not self.R.set(lock_key, token, px = int(timeout * 10**3), nx = True):
+      return False
+    self.locks[lock_key] = token
+    return True
+
+  def __release(self, p, lock_key):
+    ''' Queue lock release and wake-up of its waiters on pipeline p, if this session took the lock '''
+    token = self.locks.pop(lock_key, None)
+    if token is None:
+      return
+    ''' EVAL rather than EVALSHA: a watching pipeline runs commands immediately, without loading scripts '''
+    p.eval(RELEASE_SCRIPT, 2, lock_key, 'notify:%s:%s' % (lock_key, token), 
+           token, int(settings.CACHE_LOCK_TIMEOUT * 10**3))
+
+  def unlock(self, lock_key):
+    ''' Release a lock without storing anything, e.g. when re-caching failed '''
+    p = self.R.pipeline()
+    self.__release(p, lock_key)
+    p.execute()
+
+  def wait(self, lock_key, timeout):
+    '''
+    Block until the holder of lock_key releases it, without polling.
+    Waiters sleep on BLPOP over the wake-up list of the token of the current holder
+    (notify:<lock key>:<token>) and every woken waiter pushes the wake-up back, so that
+    the next one wakes up as well. Wake-ups of a holder never reach waiters of a later one.
+    The wait is cut short when the lock expires without being released.
+    Returns False if the lock was not released within timeout seconds.
+    '''
+    token, ttl = self.R.pipeline().get(lock_key).pttl(lock_key).execute()
+    if token is None:
+      return True
+    notify_key = 'notify:%s:%s' % (lock_key, token)
+    if ttl > 0:
+      timeout = min(timeout, ttl / 10.**3)
+    if self.R.blpop(notify_key, max(1, int(math.ceil(timeout)))) is None:
+      return self.R.get(lock_key) != token
     p = self.R.pipeline()
-    self.__delete( self.R.keys(version_pattern) )
+    p.rpush(notify_key, 1)
+    p.pexpire(notify_key, int(settings.CACHE_LOCK_TIMEOUT * 10**3))
+    p.execute()
+    return True
+
+  def fetch(self, cache_key, lock_key, timeout, locked = None):
+    '''
+    Single-flight cache lookup.
+    Returns the cached value, or None when this session acquired lock_key
+    and is expected to rebuild the entry (passing lock_key to set() to release it).
+    Raises CacheLockTimeout if another session held the lock for longer than timeout.
+    After a miss reported by lookup(), its lock state is passed with locked
+    to skip the first read of the entry.
+    '''
+    values = None if locked is None else [ None ]
+    return self.fetch_many([ cache_key ], lock_key, timeout, values, locked)[0]
+
+  def fetch_many(self, cache_keys, lock_key, timeout, values = None, locked = None):
+    '''
+    Single-flight lookup of several entries rebuilt together.
+    Returns the cached values, missing ones are None and then this session holds
+    lock_key and is expected to rebuild them (passing lock_key to mset() to release it).
+    Raises CacheLockTimeout if another session held the lock for longer than timeout.
+    Values already read, e.g. by lookup(), are passed with values to skip the first read,
+    along with the lock state when it was checked (locked) to skip the first lock attempt.
+    '''
+    start = time.time()
+    index_id = (key_version(cache_keys[0]) or (None,))[0] if cache_keys else None
+    waited = False
+    while True:
+      if values is None:
+        values = self.mget(cache_keys)
+      if not None in values:
+        if waited:
+          stats.observe('lock_wait_seconds', index_id, time.time() - start)
+        return values
+      if not locked and self.lock(lock_key, timeout):
+        stats.incr('lock_acquired', index_id)
+        if waited:
+          stats.observe('lock_wait_seconds', index_id, time.time() - start)
+        ''' entries may have been stored right before the lock was taken '''
+        values = self.mget(cache_keys)
+        if not None in values:
+          self.unlock(lock_key)
+        return values
+      values = None
+      locked = None
+      if not waited:
+        stats.incr('lock_waits', index_id)
+        waited = True
+      remaining = timeout - (time.time() - start)
+      if remaining <= 0 or not self.wait(lock_key, remaining):
+        stats.incr('lock_timeouts', index_id)
+        stats.observe('lock_wait_seconds', index_id, time.time() - start)
+        raise CacheLockTimeout('Cache lock wait timeout exceeded')
+
+  def invalidate(self, index_id, version, expires = 500):
+    '''
+    Expire the entries of an index version within expires milliseconds.
+    Entries are enumerated from the key set of the version (see _track()) with SSCAN, 
+    CACHE_INVALIDATE_BATCH keys per step and per pipeline, so Redis is never blocked
+    by a KEYS scan or by loading the whole set at once.
+    Entries are never served once the version is replaced, so this only reclaims memory:
+    on servers without SSCAN (before 2.8) they are left to their own expiration.
+    '''
+    keyset = 'keys:%d:%s' % (index_id, version)
+    batch = settings.CACHE_INVALIDATE_BATCH
+    invalidated = 0
+    cursor = 0
+    try:
+      while True:
+        cursor, keys = self.R.sscan(keyset, cursor, count = batch)
+        if keys:
+          self.__delete(keys, expires)
+          invalidated += len(keys)
+        if int(cursor) == 0:
+          break
+    except redis.ResponseError:
+      pass
+    self.__delete(keyset, expires)
+    stats.incr('invalidations', index_id)
+    stats.incr('invalidated_keys', index_id, invalidated)
   
   def version(self, index_id):
+    if settings.L1_CACHE:
+      entry = local.version(index_id)
+      if not entry is None:
+        return entry[0]
     index_key = 'version:%d' % (index_id,)
-    return self.get(index_key, False)
+    version = self.get(index_key, False)
+    if settings.L1_CACHE:
+      local.set_version(index_id, version)
+    return version
+
+  def previous_version(self, index_id):
+    ''' Version of the index before the last modification '''
+    return self.get('version:previous:%d' % (index_id,), False)
+
+  def stale_time(self, index_id):
+    ''' Seconds that entries of a replaced version may still be served (stale-while-revalidate) '''
+    return float(settings.SEARCH_CACHE_STALE_INDEX.get(int(index_id), settings.SEARCH_CACHE_STALE))
    
-  def dirty(self, index_id, action):
+  def dirty(self, index_id, action = None):
     modification_time = int(time.time() * 10**6)
     index_key = 'version:%d' % (index_id,)
     old_version = self.R.get(index_key)
     p = self.R.pipeline()
     p.watch(index_key)
     p.set(index_key, modification_time)
+    if not old_version is None:
+      p.set('version:previous:%d' % (index_id,), old_version)
+    p.publish(INVALIDATE_CHANNEL, '%d:%d' % (index_id, modification_time))
     try:
       p.execute()
-      self.invalidate(index_id, old_version)
+      if settings.L1_CACHE:
+        ''' the writing worker does not wait for its own invalidation message '''
+        local.set_version(index_id, str(modification_time))
+      ''' entries of the old version are kept around while they may be served as stale '''
+      self.invalidate(index_id, old_version, max(500, int(self.stale_time(index_id) * 10**3)))
     except redis.WatchError as e:
       pass
     return True
     ''' specific actions will give finer control over invalidations in the future '''
-
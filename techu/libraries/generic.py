@@ -2,15 +2,42 @@ import os, imp
 import MySQLdb
 import re
 import redis
+import threading
 settings_path = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[0:-1])
 settings = imp.load_source('settings', os.path.join( settings_path,  'settings.py'))
 
+redis_pools = {}
+redis_pools_lock = threading.Lock()
+
+def redis_pool():
+  '''
+  Process-wide connection pool of the configured Redis endpoint (TCP or unix socket).
+  Up to REDIS_POOL_SIZE connections are opened, callers wait up to REDIS_POOL_TIMEOUT
+  seconds for a free one. redis-py resets the pool in a forked child.
+  '''
+  endpoint = (settings.REDIS_SOCKET or settings.REDIS_HOST, settings.REDIS_PORT)
+  pool = redis_pools.get(endpoint)
+  if pool is None:
+    with redis_pools_lock:
+      pool = redis_pools.get(endpoint)
+      if pool is None:
+        kwargs = { 'password' : settings.REDIS_PASSWORD, 
+                   'max_connections' : settings.REDIS_POOL_SIZE,
+                   'timeout' : settings.REDIS_POOL_TIMEOUT }
+        if settings.REDIS_SOCKET:
+          kwargs['connection_class'] = redis.UnixDomainSocketConnection
+          kwargs['path'] = settings.REDIS_SOCKET
+        else:
+          kwargs['host'] = settings.REDIS_HOST
+          kwargs['port'] = settings.REDIS_PORT
+          if settings.REDIS_KEEPALIVE:
+            kwargs['socket_keepalive'] = True
+        pool = redis_pools[endpoint] = redis.BlockingConnectionPool(**kwargs)
+  return pool
+
 def redis26():
-  ''' Redis 2.6 client '''
-  return redis.StrictRedis(
-                 host = settings.REDIS_HOST, 
-                 port = settings.REDIS_PORT, 
-                 password = settings.REDIS_PASSWORD)
+  ''' Redis 2.6 client on the shared connection pool '''
+  return redis.StrictRedis(connection_pool = redis_pool())
 
 def cursorfetchall(cursor):
   ''' Returns all rows from a cursor as a dictionary '''
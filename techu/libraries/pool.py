@@ -0,0 +1,209 @@
+from generic import *
+from topology import topology
+from sphinxapi import SphinxClient
+from contextlib import contextmanager
+import MySQLdb
+from MySQLdb.constants import CLIENT
+import select
+import threading
+import time
+
+class Pool:
+  '''
+  Bounded, thread-safe pool of connections to a single searchd listener (host, port).
+  The most recently released connection is handed out first, connections idle for
+  longer than max_idle seconds are closed and the rest are checked before reuse.
+  Subclasses implement _open(), _check() and _close().
+  '''
+  def __init__(self, host, port, size, max_idle):
+    self.host = host
+    self.port = int(port)
+    self.size = size
+    self.max_idle = max_idle
+    self.idle = []
+    self.created = 0
+    self.condition = threading.Condition()
+
+  def _open(self):
+    raise NotImplementedError
+
+  def _check(self, conn, idle):
+    ''' Raise if a connection idle for idle seconds can not be reused '''
+    pass
+
+  def _close(self, conn):
+    pass
+
+  def _discard(self, conn):
+    with self.condition:
+      self.created -= 1
+      self.condition.notify()
+    try:
+      self._close(conn)
+    except:
+      pass
+
+  def acquire(self):
+    ''' Borrow a healthy connection, waiting up to SPHINX_POOL_TIMEOUT seconds for one '''
+    deadline = time.time() + settings.SPHINX_POOL_TIMEOUT
+    expired = []
+    conn = None
+    with self.condition:
+      while True:
+        now = time.time()
+        ''' oldest connections are at the start of the list '''
+        while self.idle and (now - self.idle[0][1]) > self.max_idle:
+          expired.append(self.idle.pop(0)[0])
+          self.created -= 1
+        if self.idle:
+          conn, released = self.idle.pop()
+          break
+        if self.created < self.size:
+          self.created += 1
+          break
+        if now >= deadline:
+          raise Exception('No free searchd connection to %s:%s' % (self.host, self.port))
+        self.condition.wait(deadline - now)
+    for c in expired:
+      try:
+        self._close(c)
+      except:
+        pass
+    if not conn is None:
+      try:
+        self._check(conn, now - released)
+        return conn
+      except:
+        try:
+          self._close(conn)
+        except:
+          pass
+    try:
+      return self._open()
+    except:
+      with self.condition:
+        self.created -= 1
+        self.condition.notify()
+      raise
+
+  def release(self, conn):
+    with self.condition:
+      self.idle.append((conn, time.time()))
+      self.condition.notify()
+
+  @contextmanager
+  def connection(self):
+    '''
+    Borrow a connection for the duration of a with-block.
+    Connections that raised an error are closed instead of being returned to the pool.
+    '''
+    conn = self.acquire()
+    try:
+      yield conn
+    except:
+      self._discard(conn)
+      raise
+    self.release(conn)
+
+class ConnectionPool(Pool):
+  '''
+  mysql41 (SphinxQL) connections.
+  Connections idle for longer than SPHINX_POOL_PING seconds are pinged before reuse.
+  '''
+  client_flag = 0
+
+  def __init__(self, host, port):
+    Pool.__init__(self, host, port, settings.SPHINX_POOL_SIZE, settings.SPHINX_POOL_MAX_IDLE)
+
+  def _open(self):
+    return MySQLdb.connect(host = self.host, port = self.port, user = '', passwd = '',
+                           charset = 'utf8', use_unicode = True, client_flag = self.client_flag)
+
+  def _check(self, conn, idle):
+    if idle > settings.SPHINX_POOL_PING:
+      conn.ping()
+
+  def _close(self, conn):
+    conn.close()
+
+class BatchConnectionPool(ConnectionPool):
+  '''
+  mysql41 connections accepting multi-statement batches (search & SHOW META, search/multi).
+  Kept apart from the connections used for writes, which only ever run one statement.
+  '''
+  client_flag = CLIENT.MULTI_STATEMENTS | CLIENT.MULTI_RESULTS
+
+class ClientPool(Pool):
+  '''
+  Persistent (SEARCHD_COMMAND_PERSIST) SphinxClient connections to the binary API,
+  so that excerpts and native searches skip the connect & version handshake.
+  Clients come back with their query settings reset and are dropped after an error.
+  '''
+  def __init__(self, host, port):
+    Pool.__init__(self, host, port, settings.SPHINX_CLIENT_POOL_SIZE, settings.SPHINX_CLIENT_MAX_IDLE)
+
+  def _open(self):
+    cl = SphinxClient()
+    cl.SetServer(str(self.host), self.port)
+    cl.SetConnectTimeout(float(settings.SPHINX_CLIENT_TIMEOUT))
+    if not cl.Open():
+      raise Exception('Connection to searchd %s:%s failed (%s)' % (self.host, self.port, cl.GetLastError()))
+    return cl
+
+  def _check(self, cl, idle):
+    ''' A live idle socket is writable and has nothing to read '''
+    sr, sw, _ = select.select([ cl._socket ], [ cl._socket ], [], 0)
+    if len(sr) > 0 or len(sw) == 0:
+      raise Exception('Persistent connection closed by searchd')
+
+  def _close(self, cl):
+    cl.Close()
+
+  def release(self, cl):
+    if cl._error or not cl._socket:
+      self._discard(cl)
+      return
+    ''' forget filters, limits etc. of the previous user but keep the socket '''
+    sock = cl._socket
+    cl.__init__()
+    cl._socket = sock
+    cl.SetServer(str(self.host), self.port)
+    cl.SetConnectTimeout(float(settings.SPHINX_CLIENT_TIMEOUT))
+    Pool.release(self, cl)
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host, port, pool_class = ConnectionPool):
+  ''' Process-wide pool for a searchd listener '''
+  key = (pool_class, host, int(port))
+  pool = pools.get(key)
+  if pool is None:
+    with pools_lock:
+      pool = pools.get(key)
+      if pool is None:
+        pool = pools[key] = pool_class(host, port)
+  return pool
+
+def sphinx_connection(index_id, batch = False):
+  ''' 
+  Borrow a mysql41 connection to the searchd serving an index,
+  with batch multi-statement queries are allowed 
+  '''
+  index = topology.get(index_id)
+  if index is None or index['port'] is None:
+    raise Exception('No mysql41 listener for index %s' % (index_id,))
+  return get_pool(index['host'], index['port'], BatchConnectionPool if batch else ConnectionPool).connection()
+
+def sphinx_client(index_id):
+  ''' Borrow a persistent SphinxClient connected to the searchd serving an index '''
+  index = topology.get(index_id)
+  if index is None or index['api_port'] is None:
+    raise Exception('No binary API listener for index %s' % (index_id,))
+  return get_pool(index['api_host'], index['api_port'], ClientPool).connection()
+
+def shard_client(shard):
+  ''' Borrow a persistent SphinxClient connected to the searchd serving a shard of a distributed index '''
+  if shard['port'] is None:
+    raise Exception('No binary API listener for shard %s' % (shard['index'],))
+  return get_pool(shard['host'], shard['port'], ClientPool).connection()
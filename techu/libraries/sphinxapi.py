@@ -102,6 +102,10 @@ SPH_ATTR_TYPES = (SPH_ATTR_NONE,
 				  SPH_ATTR_MULTI,
 				  SPH_ATTR_MULTI64)
 
+# attribute types with variable-length values, and struct formats of the fixed-width ones
+SPH_ATTR_VARIABLE = (SPH_ATTR_STRING, SPH_ATTR_FACTORS, SPH_ATTR_MULTI, SPH_ATTR_MULTI64)
+SPH_ATTR_FORMATS = { SPH_ATTR_FLOAT:'f', SPH_ATTR_BIGINT:'q' }
+
 # known grouping functions
 SPH_GROUPBY_DAY	 		= 0
 SPH_GROUPBY_WEEK		= 1
@@ -156,6 +160,7 @@ class SphinxClient:
 		self._error			= ''							# last error message
 		self._warning		= ''							# last warning message
 		self._reqs			= []							# requests array for multi-query
+		self._columnar		= False							# return matches as per-attribute lists
 		
 	def __del__ (self):
 		if self._socket:
@@ -250,16 +255,15 @@ class SphinxClient:
 		"""
 		INTERNAL METHOD, DO NOT CALL. Gets and checks response packet from searchd server.
 		"""
-		(status, ver, length) = unpack('>2HL', sock.recv(8))
-		response = ''
-		left = length
-		while left>0:
-			chunk = sock.recv(left)
-			if chunk:
-				response += chunk
-				left -= len(chunk)
-			else:
-				break
+		header = self._Recv(sock, 8)
+		if len(header)!=8:
+			if not self._socket:
+				sock.close()
+			self._error = 'failed to read searchd response header'
+			return None
+
+		(status, ver, length) = unpack('>2HL', header)
+		response = self._Recv(sock, length)
 
 		if not self._socket:
 			sock.close()
@@ -300,19 +304,31 @@ class SphinxClient:
 		return response
 
 
+	def _Recv ( self, sock, length ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Receive up to length bytes from searchd server.
+		Reads into a preallocated buffer, so large responses are not rebuilt chunk by chunk.
+		Returns fewer bytes only if the connection was closed.
+		"""
+		buf = bytearray(length)
+		view = memoryview(buf)
+		read = 0
+		while read<length:
+			received = sock.recv_into ( view[read:], length-read )
+			if not received:
+				break
+			read += received
+		if read<length:
+			return str(buf[:read])
+		return str(buf)
+
+
 	def _Send ( self, sock, req ):
 		"""
 		INTERNAL METHOD, DO NOT CALL. send request to searchd server.
 		"""
-		total = 0
-		while True:
-			sent = sock.send ( req[total:] )
-			if sent<=0:
-				break
-				
-			total = total + sent
-		
-		return total
+		sock.sendall ( req )
+		return len(req)
 		
 
 	def SetLimits (self, offset, limit, maxmatches=0, cutoff=0):
@@ -334,7 +350,7 @@ class SphinxClient:
 		"""
 		Set maximum query time, in milliseconds, per-index. 0 means 'do not limit'.
 		"""
-		assert(isinstance(maxquerytime,int) and maxquerytime>0)
+		assert(isinstance(maxquerytime,int) and maxquerytime>=0)
 		self._maxquerytime = maxquerytime
 
 
@@ -553,6 +569,14 @@ class SphinxClient:
 		self._outerlimit = 0
 		self._hasouter = False
 
+	def SetColumnar (self, columnar):
+		"""
+		Return matches of RunQueries() as per-attribute lists (result['columns'])
+		instead of one dictionary per match (result['matches']).
+		"""
+		assert(isinstance(columnar, bool))
+		self._columnar = columnar
+
 	def Query (self, query, index='*', comment=''):
 		"""
 		Connect to searchd server and run given search query.
@@ -704,9 +728,8 @@ class SphinxClient:
 		if not sock:
 			return None
 
-		req = ''.join(self._reqs)
-		length = len(req)+8
-		req = pack('>HHLLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, 0, len(self._reqs))+req
+		length = sum ( [ len(req) for req in self._reqs ] ) + 8
+		req = ''.join ( [ pack('>HHLLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, 0, len(self._reqs)) ] + self._reqs )
 		self._Send ( sock, req )
 
 		response = self._GetResponse(sock, VER_COMMAND_SEARCH)
@@ -777,60 +800,10 @@ class SphinxClient:
 			p += 4
 		
 			# read matches
-			result['matches'] = []
-			while count>0 and p<max_:
-				count -= 1
-				if id64:
-					doc, weight = unpack('>QL', response[p:p+12])
-					p += 12
-				else:
-					doc, weight = unpack('>2L', response[p:p+8])
-					p += 8
-
-				match = { 'id':doc, 'weight':weight, 'attrs':{} }
-				for i in range(len(attrs)):
-					if attrs[i][1] == SPH_ATTR_FLOAT:
-						match['attrs'][attrs[i][0]] = unpack('>f', response[p:p+4])[0]
-					elif attrs[i][1] == SPH_ATTR_BIGINT:
-						match['attrs'][attrs[i][0]] = unpack('>q', response[p:p+8])[0]
-						p += 4
-					elif attrs[i][1] == SPH_ATTR_STRING:
-						slen = unpack('>L', response[p:p+4])[0]
-						p += 4
-						match['attrs'][attrs[i][0]] = ''
-						if slen>0:
-							match['attrs'][attrs[i][0]] = response[p:p+slen]
-						p += slen-4
-					elif attrs[i][1] == SPH_ATTR_FACTORS:
-						slen = unpack('>L', response[p:p+4])[0]
-						p += 4
-						match['attrs'][attrs[i][0]] = ''
-						if slen>0:
-							match['attrs'][attrs[i][0]] = response[p:p+slen-4]
-							p += slen-4
-						p -= 4
-					elif attrs[i][1] == SPH_ATTR_MULTI:
-						match['attrs'][attrs[i][0]] = []
-						nvals = unpack('>L', response[p:p+4])[0]
-						p += 4
-						for n in range(0,nvals,1):
-							match['attrs'][attrs[i][0]].append(unpack('>L', response[p:p+4])[0])
-							p += 4
-						p -= 4
-					elif attrs[i][1] == SPH_ATTR_MULTI64:
-						match['attrs'][attrs[i][0]] = []
-						nvals = unpack('>L', response[p:p+4])[0]
-						nvals = nvals/2
-						p += 4
-						for n in range(0,nvals,1):
-							match['attrs'][attrs[i][0]].append(unpack('>q', response[p:p+8])[0])
-							p += 8
-						p -= 4
-					else:
-						match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
-					p += 4
-
-				result['matches'].append ( match )
+			if self._columnar:
+				result['columns'], p = self._DecodeColumns ( response, p, count, attrs, id64 )
+			else:
+				result['matches'], p = self._DecodeMatches ( response, p, count, attrs, id64 )
 
 			result['total'], result['total_found'], result['time'], words = unpack('>4L', response[p:p+16])
 
@@ -853,6 +826,94 @@ class SphinxClient:
 		return results
 	
 
+	def _MatchSteps (self, attrs, id64):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Compiles a result set schema into decoding steps.
+		Runs of fixed-width values (document id and weight included) are read with
+		a single precompiled struct, variable-length attributes one at a time.
+		Each step is a (struct, names) or (attribute type, name) tuple.
+		"""
+		if id64:
+			fmt = [ 'Q', 'L' ]
+		else:
+			fmt = [ 'L', 'L' ]
+		names = []
+		steps = []
+		for name, type_ in attrs:
+			if type_ in SPH_ATTR_VARIABLE:
+				if fmt:
+					steps.append ( ( _Struct ( '>' + ''.join(fmt) ), names ) )
+					fmt, names = [], []
+				steps.append ( ( type_, name ) )
+			else:
+				fmt.append ( SPH_ATTR_FORMATS.get ( type_, 'L' ) )
+				names.append ( name )
+		if fmt:
+			steps.append ( ( _Struct ( '>' + ''.join(fmt) ), names ) )
+		return steps
+
+
+	def _DecodeMatches (self, response, p, count, attrs, id64):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Decodes matches into one dictionary per match.
+		"""
+		steps = self._MatchSteps ( attrs, id64 )
+		head, head_names = steps[0]
+		steps = steps[1:]
+		max_ = len(response)
+		matches = []
+		while count>0 and p<max_:
+			count -= 1
+			values = head.unpack_from ( response, p )
+			p += head.size
+			match_attrs = dict ( zip ( head_names, values[2:] ) )
+			for step, names in steps:
+				if isinstance(step, Struct):
+					match_attrs.update ( zip ( names, step.unpack_from ( response, p ) ) )
+					p += step.size
+				else:
+					match_attrs[names], p = _UnpackVariable ( response, p, step )
+			matches.append ( { 'id':values[0], 'weight':values[1], 'attrs':match_attrs } )
+		return matches, p
+
+
+	def _DecodeColumns (self, response, p, count, attrs, id64):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Decodes matches into one list per attribute.
+		"""
+		steps = self._MatchSteps ( attrs, id64 )
+		head, head_names = steps[0]
+		steps = steps[1:]
+		columns = { 'id':[], 'weight':[], 'attrs':dict ( [ ( attr[0], [] ) for attr in attrs ] ) }
+		ids = columns['id'].append
+		weights = columns['weight'].append
+		head_columns = [ columns['attrs'][name].append for name in head_names ]
+		step_columns = []
+		for step, names in steps:
+			if isinstance(step, Struct):
+				step_columns.append ( [ columns['attrs'][name].append for name in names ] )
+			else:
+				step_columns.append ( columns['attrs'][names].append )
+		max_ = len(response)
+		while count>0 and p<max_:
+			count -= 1
+			values = head.unpack_from ( response, p )
+			p += head.size
+			ids ( values[0] )
+			weights ( values[1] )
+			for append, value in zip ( head_columns, values[2:] ):
+				append ( value )
+			for (step, names), append in zip ( steps, step_columns ):
+				if isinstance(step, Struct):
+					for column, value in zip ( append, step.unpack_from ( response, p ) ):
+						column ( value )
+					p += step.size
+				else:
+					value, p = _UnpackVariable ( response, p, step )
+					append ( value )
+		return columns, p
+
+
 	def BuildExcerpts (self, docs, index, words, opts=None):
 		"""
 		Connect to searchd server and generate exceprts from given documents.
@@ -940,13 +1001,11 @@ class SphinxClient:
 			req.append(pack('>L', len(doc)))
 			req.append(doc)
 
-		req = ''.join(req)
-
 		# send query, get response
-		length = len(req)
+		length = sum ( [ len(chunk) for chunk in req ] )
 
 		# add header
-		req = pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length)+req
+		req = ''.join ( [ pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length) ] + req )
 		self._Send ( sock, req )
 
 		response = self._GetResponse(sock, VER_COMMAND_EXCERPT )
@@ -1188,6 +1247,39 @@ class SphinxClient:
 		tag = unpack ( '>L', response[0:4] )[0]
 		return tag
 
+_structs = {}
+
+def _Struct ( fmt ):
+	"""
+	Precompiled (and memoized) struct for a format string.
+	"""
+	st = _structs.get(fmt)
+	if st is None:
+		st = _structs.setdefault ( fmt, Struct(fmt) )
+	return st
+
+_uint32 = _Struct('>L')
+
+def _UnpackVariable ( response, p, type_ ):
+	"""
+	Reads a variable-length attribute value at offset p.
+	Returns the value and the offset of the next value.
+	"""
+	length = _uint32.unpack_from ( response, p )[0]
+	p += 4
+	if type_ == SPH_ATTR_STRING:
+		return response[p:p+length], p+length
+	if type_ == SPH_ATTR_FACTORS:
+		# blob length includes the length field itself
+		if length>0:
+			return response[p:p+length-4], p+length-4
+		return '', p
+	if type_ == SPH_ATTR_MULTI:
+		return list ( _Struct ( '>%dL' % length ).unpack_from ( response, p ) ), p+4*length
+	# SPH_ATTR_MULTI64, length is given in 32-bit words
+	length = length/2
+	return list ( _Struct ( '>%dq' % length ).unpack_from ( response, p ) ), p+8*length
+
 def AssertInt32 ( value ):
 	assert(isinstance(value, (int, long)))
 	assert(value>=-2**32-1 and value<=2**32-1)
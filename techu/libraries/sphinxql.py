@@ -0,0 +1,248 @@
+from generic import *
+from sphinxapi import *
+from collections import OrderedDict
+import json
+import re
+import threading
+
+''' Defaults & accepted values of search requests '''
+MATCH_MODES = {
+  'mode' : {
+      'extended' : SPH_MATCH_EXTENDED2,
+      'boolean'  : SPH_MATCH_BOOLEAN,
+      'all'      : SPH_MATCH_ALL,
+      'phrase'   : SPH_MATCH_PHRASE,
+      'fullscan' : SPH_MATCH_FULLSCAN,
+      'any'      : SPH_MATCH_ANY,
+    }
+}
+SEARCH_OPTIONS = {
+  'sortby'      : '',
+  'mode'        : 'extended',
+  'groupby'     : '',
+  'groupsort'   : '',
+  'offset'      : 0,
+  'limit'       : 1000,
+  'max_matches' : 0,
+  'cutoff'      : 0,
+  'fields'      : '*',
+}
+SPHINXQL_LIST_OPTIONS = {
+  'ranker' : [ 'proximity_bm25', 'bm25', 'none', 'wordcount', 'proximity',
+               'matchany', 'fieldmask', 'sph04', 'expr', 'export' ],
+  'idf' : [ 'normalized', 'plain'],
+  'sort_method'  : ['pq', 'kbuffer' ]
+}
+SPHINXQL_OPTIONS = {
+  'agent_query_timeout' : 10000,
+  'boolean_simplify' : 0,
+  'comment' : '',
+  'cutoff'  : 0,
+  'field_weights' : '',
+  'global_idf' : '',
+  'idf' : 'normalized',
+  'index_weights'  : '',
+  'max_matches' : 10000,
+  'max_query_time' : 10000,
+  'ranker' : 'proximity_bm25',
+  'retry_count' : 2,
+  'retry_delay' : 100,
+  'reverse_scan' : 0,
+  'sort_method'  : 'pq'
+}
+ORDER_DIRECTION = {
+  '-1'   : 'DESC',
+  'DESC' : 'DESC',
+  '1'    : 'ASC',
+  'ASC'  : 'ASC',
+}
+
+'''
+SELECT
+select_expr [, select_expr ...]
+FROM index [, index2 ...]
+[WHERE where_condition]
+[GROUP BY {col_name | expr_alias}]
+[WITHIN GROUP ORDER BY {col_name | expr_alias} {ASC | DESC}]
+[ORDER BY {col_name | expr_alias} {ASC | DESC} [, ...]]
+[LIMIT [offset,] row_count]
+[OPTION opt_name = opt_value [, ...]]
+'''
+SQL_SEQUENCE = [ ('SELECT', 'fields'), ('FROM', 'indexes'), ('WHERE', 'where'),
+                 ('GROUP BY', 'group_by'), ('WITHIN GROUP ORDER BY', 'order_within_group'),
+                 ('ORDER BY', 'order_by'), ('LIMIT', 'limit'), ('OPTION', 'option') ]
+
+''' 
+Parts of a request pasted into SQL are checked against these, values are always bound.
+Attribute names (optionally @ prefixed or a function call without arguments e.g. WEIGHT()),
+sort directions, where operators, option values (numbers, words, single-quoted strings 
+or a function of one, e.g. ranker = expr('sum(lcs)')) and select expressions
+without statement separators, comments or unbalanced quotes.
+'''
+CURSOR_ALIAS = '_after'
+IDENTIFIER = re.compile(r'^@?[A-Za-z_][A-Za-z0-9_]*(\(\))?$')
+OPERATORS = ( '=', '!=', '<>', '<', '<=', '>', '>=', 'IN', 'NOT IN' )
+OPTION_VALUE = re.compile(r"^([A-Za-z0-9_.\-]+|([A-Za-z_]+\()?'[^'\\;]*'\)?)$")
+UNSAFE_EXPRESSION = re.compile(r"[;#`\\]|--|/\*")
+
+def identifier(name):
+  ''' Return an attribute / index / option name, raise if it is not a plain identifier '''
+  if not isinstance(name, basestring) or IDENTIFIER.match(name) is None:
+    raise Exception('Invalid identifier "%s"' % (name,))
+  return name
+
+def operator(name):
+  ''' Return a normalized where operator, raise if it is not supported '''
+  normalized = ' ' . join(str(name).upper().split())
+  if not normalized in OPERATORS:
+    raise Exception('Invalid operator "%s"' % (name,))
+  return normalized
+
+def direction(value):
+  ''' Return ASC or DESC for a sort direction (1 / -1 / asc / desc), raise otherwise '''
+  normalized = str(value).upper()
+  if not normalized in ORDER_DIRECTION:
+    raise Exception('Invalid sort direction "%s"' % (value,))
+  return ORDER_DIRECTION[normalized]
+
+def option_value(value):
+  ''' Return an OPTION value as text, raise if it is not a number, word or quoted string '''
+  value = unicode(value)
+  if OPTION_VALUE.match(value) is None:
+    raise Exception('Invalid option value "%s"' % (value,))
+  return value
+
+def keyset(after, literal = False):
+  '''
+  Select expression of keyset pagination, true for the rows sorted after the values of 
+  after = { 'order' : [[ field, 'ASC' | 'DESC' ], ...], 'values' : [ ... ] }, aliased CURSOR_ALIAS:
+  (a > x) OR (a = x AND b < y) OR (a = x AND b = y AND id > z) ...
+  Values are %s placeholders (bound in the order of keyset_values()) unless literal is set.
+  Only integer values are accepted: float attributes are returned rounded to 6 decimals
+  and the rounded value does not compare equal to the stored one.
+  '''
+  conditions = []
+  equal = []
+  for (field, order), value in zip(after['order'], after['values']):
+    if not isinstance(value, (int, long)) or isinstance(value, bool):
+      raise Exception('Cursor pagination requires integer sort attributes')
+    if literal:
+      value = str(value)
+    else:
+      value = '%s'
+    operator = '<' if direction(order) == 'DESC' else '>'
+    conditions.append('(' + ' AND ' . join(equal + [ '%s%s%s' % (identifier(field), operator, value) ]) + ')')
+    equal.append('%s=%s' % (field, value))
+  return '(%s) AS %s' % (' OR ' . join(conditions), CURSOR_ALIAS)
+
+def keyset_values(after):
+  ''' Values bound to the placeholders of keyset(after), in placeholder order '''
+  values = after['values']
+  return [ value for n in range(len(values)) for value in values[:n + 1] ]
+
+def expression(value):
+  ''' Return a select expression, raise if it could end the statement or hide a comment '''
+  if not isinstance(value, basestring) or UNSAFE_EXPRESSION.search(value) or value.count("'") % 2:
+    raise Exception('Invalid select expression "%s"' % (value,))
+  return value
+
+class Compiler:
+  '''
+  Translates JSON search requests to SphinxQL SELECT statements.
+  Statements are compiled to templates with placeholders for every literal value
+  (cursor values, where values, MATCH query, offset & count) and memoized by query shape,
+  i.e. the request with these values left out, in a bounded LRU of
+  SPHINXQL_TEMPLATE_CACHE_SIZE templates per process.
+  Requests of a known shape only have their values extracted and bound.
+  '''
+  def __init__(self, size):
+    self.size = size
+    self.templates = OrderedDict()
+    self.lock = threading.Lock()
+
+  def _where(self, r):
+    ''' where conditions in a fixed order: [ (field, operator, value) ] '''
+    where = r.get('where')
+    if not isinstance(where, dict):
+      return []
+    return [ (field, name, value) for field in sorted(where) for name, value in where[field] ]
+
+  def _limit(self, r):
+    limit = r.get('limit')
+    if not isinstance(limit, dict):
+      limit = {}
+    return [ int(limit.get('offset', SEARCH_OPTIONS['offset'])), int(limit.get('count', SEARCH_OPTIONS['limit'])) ]
+
+  def shape(self, index, r):
+    ''' Shape key of a request and the values to bind, in placeholder order '''
+    where = self._where(r)
+    after = r.get('after')
+    values = keyset_values(after) if after else []
+    values += [ value for field, name, value in where ]
+    if 'q' in r:
+      values.append(r['q'])
+    values += self._limit(r)
+    shape = [ index ]
+    for clause, key in SQL_SEQUENCE:
+      if key == 'fields':
+        shape.append([ r.get(key), after['order'] if after else None ])
+      elif key == 'where':
+        shape.append([ (field, name, isinstance(value, list)) for field, name, value in where ] + [ 'q' in r ])
+      elif key != 'limit':
+        shape.append(r.get(key))
+    return (json.dumps(shape, sort_keys = True), values)
+
+  def translate(self, index, r):
+    ''' SQL template of a request, literal values are %s placeholders '''
+    sql = {}
+    for sql_clause, key in SQL_SEQUENCE:
+      sql[key] = ''
+    escape = lambda s: s.replace('%', '%%')
+    sql['indexes'] = index
+    if isinstance(r.get('indexes'), list):
+      sql['indexes'] = ',' . join([ index ] + map(identifier, r['indexes']))
+    if isinstance(r.get('fields'), list):
+      sql['fields'] = escape(',' . join(map(expression, r['fields'])))
+    else:
+      sql['fields'] = SEARCH_OPTIONS['fields']
+    if r.get('after'):
+      sql['fields'] += ',' + keyset(r['after'])
+    if r.get('group_by'):
+      sql['group_by'] = identifier(r['group_by'])
+    sql['limit'] = '%s, %s'
+    if r.get('order_by'):
+      sql['order_by'] = ',' . join([ '%s %s' % (identifier(order[0]), direction(order[1])) for order in r['order_by'] ])
+    if r.get('order_within_group'):
+      sql['order_within_group'] = ',' . join([ '%s %s' % (identifier(order[0]), direction(order[1])) for order in r['order_within_group'] ])
+    ''' dictionary e.g. { 'date_from' : [[ '>' , 13445454350]] } '''
+    where = [ '%s %s %%s' % (identifier(field), operator(name)) for field, name, value in self._where(r) ]
+    if 'q' in r:
+      where.append('MATCH(%s)')
+    sql['where'] = ' AND ' . join(where)
+    if isinstance(r.get('option'), dict):
+      option = []
+      for name, value in r['option'].iteritems():
+        if isinstance(value, dict):
+          value = '(' + (','. join([ '%s = %s' % (identifier(k), option_value(value[k])) for k in value.keys() ])) + ')'
+        else:
+          value = option_value(value)
+        option.append('%s = %s' % (identifier(name), value))
+      sql['option'] = escape(',' . join(option))
+    return ' ' . join([ clause[0] + ' ' + sql[clause[1]] for clause in SQL_SEQUENCE if sql[clause[1]] != '' ])
+
+  def compile(self, index, r):
+    ''' SQL statement (template) of a request and the list of values to bind '''
+    key, values = self.shape(index, r)
+    with self.lock:
+      template = self.templates.pop(key, None)
+      if not template is None:
+        self.templates[key] = template
+        return (template, values)
+    template = self.translate(index, r)
+    with self.lock:
+      self.templates[key] = template
+      while len(self.templates) > self.size:
+        self.templates.popitem(last = False)
+    return (template, values)
+
+compiler = Compiler(settings.SPHINXQL_TEMPLATE_CACHE_SIZE)
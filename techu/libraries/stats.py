@@ -0,0 +1,88 @@
+from generic import *
+import os
+import time
+import threading
+
+''' Histogram upper bounds, seconds for latencies and bytes for entry sizes '''
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10.)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Stats:
+  '''
+  In-process counters and histograms of the result cache, kept per index id.
+  Counters: cache_hits, cache_misses, cache_stale, lock_acquired, lock_waits,
+  lock_timeouts, invalidations, invalidated_keys.
+  Histograms: lock_wait_seconds, entry_bytes.
+  Every worker keeps its own figures (reported along with its pid),
+  so a scraper aggregates them across workers.
+  '''
+  def __init__(self):
+    self.counters = {}
+    self.histograms = {}
+    self.started = time.time()
+    self.lock = threading.Lock()
+
+  def incr(self, name, index_id, value = 1):
+    if not settings.STATS:
+      return
+    key = (name, index_id)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, index_id, value, buckets = LATENCY_BUCKETS):
+    ''' Record a sample of a histogram, samples above the last bucket only count in +Inf '''
+    if not settings.STATS:
+      return
+    key = (name, index_id)
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = { 'buckets' : buckets, 'counts' : [ 0 ] * len(buckets), 'sum' : 0., 'count' : 0 }
+      for n, bound in enumerate(buckets):
+        if value <= bound:
+          histogram['counts'][n] += 1
+          break
+      histogram['sum'] += value
+      histogram['count'] += 1
+
+  def snapshot(self):
+    ''' Figures per index id as a dictionary, histogram bucket counts are cumulative '''
+    with self.lock:
+      counters = self.counters.items()
+      histograms = [ (key, dict(histogram, counts = list(histogram['counts']))) for key, histogram in self.histograms.items() ]
+    indexes = {}
+    for (name, index_id), value in counters:
+      indexes.setdefault(index_id, {})[name] = value
+    for (name, index_id), histogram in histograms:
+      cumulative = 0
+      buckets = []
+      for bound, count in zip(histogram['buckets'], histogram['counts']):
+        cumulative += count
+        buckets.append([ bound, cumulative ])
+      indexes.setdefault(index_id, {})[name] = { 'buckets' : buckets, 'sum' : histogram['sum'], 'count' : histogram['count'] }
+    return { 'pid' : os.getpid(), 'uptime' : time.time() - self.started, 'indexes' : indexes }
+
+  def prometheus(self):
+    ''' Figures in the Prometheus text exposition format (version 0.0.4), grouped by metric '''
+    snapshot = self.snapshot()
+    pid = snapshot['pid']
+    families = {}
+    for index_id, figures in snapshot['indexes'].items():
+      for name, value in figures.items():
+        families.setdefault(name, []).append(('index="%s",pid="%d"' % (index_id, pid), value))
+    lines = [ '# TYPE techu_uptime_seconds gauge', 'techu_uptime_seconds{pid="%d"} %f' % (pid, snapshot['uptime']) ]
+    for name, samples in sorted(families.items()):
+      if not isinstance(samples[0][1], dict):
+        lines.append('# TYPE techu_%s_total counter' % name)
+        lines += [ 'techu_%s_total{%s} %d' % (name, labels, value) for labels, value in sorted(samples) ]
+        continue
+      lines.append('# TYPE techu_%s histogram' % name)
+      for labels, value in sorted(samples):
+        for bound, count in value['buckets']:
+          lines.append('techu_%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+        lines.append('techu_%s_bucket{%s,le="+Inf"} %d' % (name, labels, value['count']))
+        lines.append('techu_%s_sum{%s} %f' % (name, labels, value['sum']))
+        lines.append('techu_%s_count{%s} %d' % (name, labels, value['count']))
+    return '\n' . join(lines) + '\n'
+
+stats = Stats()
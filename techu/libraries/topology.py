@@ -0,0 +1,155 @@
+from generic import *
+from django.db import connection
+import time
+import threading
+
+def parse_listen(value):
+  '''
+  Split a searchd "listen" directive into (host, port, protocol)
+  e.g. "9312", "127.0.0.1:9306:mysql41", "/var/run/searchd.sock:mysql41"
+  '''
+  parts = value.strip().split(':')
+  protocol = 'sphinx'
+  if parts[-1] in ('mysql41', 'sphinx'):
+    protocol = parts.pop()
+  if parts[0].startswith('/'):
+    return (':'.join(parts), None, protocol)
+  port = int(parts.pop())
+  host = None
+  if parts and not parts[0] in ('', '0.0.0.0'):
+    host = parts[0]
+  return (host, port, protocol)
+
+def parse_agent(value):
+  '''
+  Remote shards of a distributed index "agent" directive as [ (host, port, index) ]
+  e.g. "box2:9312:chunk2,chunk3", of mirrors "box2:9312|box3:9312:chunk2" the first one is used.
+  Agents on unix sockets are not returned.
+  '''
+  mirrors = value.strip().split('|')
+  names = mirrors[-1].rsplit(':', 1)[1]
+  parts = mirrors[0].split(':')
+  if parts[0].startswith('/'):
+    return []
+  if len(parts) > 2:
+    names = parts[2]
+  return [ (parts[0], int(parts[1]), name.strip()) for name in names.split(',') if name.strip() ]
+
+class Topology:
+  '''
+  Process-wide registry of the index / searchd layout.
+  Maps each active index id to its name and the host & port of the mysql41 (host, port)
+  and binary API (api_host, api_port) listeners of its searchd. The host is the sphinx_host
+  option of the searchd, else the address the listener is bound to, else APPHOST.
+  Distributed indexes also list their shards (local, agent and agent_persistent indexes) 
+  with the host & binary API port serving each one; an index with an agent that can not be
+  resolved (unix socket or malformed directive) is flagged "unresolved".
+  The registry is loaded once per worker and reloaded only when the configuration
+  version kept in Redis is bumped (see touch()), which is checked at most
+  every TOPOLOGY_CHECK_INTERVAL seconds.
+  '''
+  VERSION_KEY = 'topology:version'
+
+  def __init__(self):
+    self.indexes = {}
+    self.version = None
+    self.generation = 0
+    self.checked = 0.
+    self.expired = True
+    self.lock = threading.Lock()
+
+  def load(self):
+    ''' Read indexes and searchd listeners from the Techu database '''
+    cursor = connection.cursor()
+    cursor.execute('''SELECT sp_searchd_id, sp_option_id, value FROM sp_searchd_option
+                      WHERE sp_option_id IN (138, 188)''')
+    searchd = {}
+    for row in cursorfetchall(cursor):
+      s = searchd.setdefault(row['sp_searchd_id'], { 'sphinx_host' : None, 'host' : None, 'port' : None, 'api_host' : None, 'api_port' : None })
+      if row['sp_option_id'] == 188:
+        s['sphinx_host'] = row['value'].strip() or None
+        continue
+      host, port, protocol = parse_listen(row['value'])
+      if port is None:
+        continue
+      ''' wildcard binds have no host (see parse_listen) '''
+      if protocol == 'mysql41':
+        s['host'], s['port'] = host, port
+      else:
+        s['api_host'], s['api_port'] = host, port
+    cursor.execute('''SELECT i.id, i.name, i.index_type, scs.sp_searchd_id
+                      FROM sp_indexes i
+                      JOIN sp_configuration_index sci ON i.id = sci.sp_index_id
+                      JOIN sp_configuration_searchd scs ON sci.sp_configuration_id = scs.sp_configuration_id
+                      WHERE sci.is_active''')
+    indexes = {}
+    for row in cursorfetchall(cursor):
+      s = searchd.get(row['sp_searchd_id'], {})
+      indexes[int(row['id'])] = {
+        'id'         : int(row['id']),
+        'name'       : row['name'],
+        'index_type' : row['index_type'],
+        'searchd'    : row['sp_searchd_id'],
+        'host'       : s.get('sphinx_host') or s.get('host') or settings.APPHOST,
+        'port'       : s.get('port'),
+        'api_host'   : s.get('sphinx_host') or s.get('api_host') or settings.APPHOST,
+        'api_port'   : s.get('api_port'),
+        'shards'     : [],
+        'unresolved' : False,
+      }
+    ''' local (32), agent (33) & agent_persistent (34) indexes of distributed indexes '''
+    cursor.execute('''SELECT sp_index_id, sp_option_id, value FROM sp_index_option
+                      WHERE sp_option_id IN (32, 33, 34) AND is_active''')
+    for row in cursorfetchall(cursor):
+      index = indexes.get(int(row['sp_index_id']))
+      if index is None:
+        continue
+      if row['sp_option_id'] == 32:
+        index['shards'].append({ 'host' : index['api_host'], 'port' : index['api_port'], 'index' : row['value'].strip() })
+        continue
+      try:
+        agents = parse_agent(row['value'])
+      except (IndexError, ValueError):
+        agents = []
+      if not agents:
+        index['unresolved'] = True
+      for host, port, name in agents:
+        index['shards'].append({ 'host' : host, 'port' : port, 'index' : name })
+    self.indexes = indexes
+    self.generation += 1
+    return indexes
+
+  def refresh(self):
+    ''' Reload the registry if it is empty or the configuration version has changed '''
+    now = time.time()
+    if not self.expired and (now - self.checked) < settings.TOPOLOGY_CHECK_INTERVAL:
+      return False
+    with self.lock:
+      if not self.expired and (now - self.checked) < settings.TOPOLOGY_CHECK_INTERVAL:
+        return False
+      self.checked = now
+      try:
+        version = redis26().get(self.VERSION_KEY)
+      except:
+        version = self.version
+      if not self.expired and version == self.version:
+        return False
+      self.load()
+      self.version = version
+      self.expired = False
+    return True
+
+  def touch(self):
+    ''' Bump the configuration version so that every worker reloads its registry '''
+    try:
+      redis26().incr(self.VERSION_KEY)
+    except:
+      pass
+    self.expired = True
+
+  def get(self, index_id):
+    ''' Topology entry of an index or None '''
+    self.refresh()
+    return self.indexes.get(int(index_id))
+
+topology = Topology()
@@ -160,12 +160,48 @@ SEARCH_FAILURE_LEVEL = SEARCH_FAIL_WARNING
 SEARCH_CACHE = True
 EXCERPTS_CACHE = True
 EXCERPTS_CACHE_EXPIRE = 10 # Cache expiration in seconds
+EXCERPTS_CHUNK_BYTES = 256 * 1024 # Documents are sent to searchd in chunks of this size, built concurrently
+SEARCHD_THREADS = 8 # Worker threads per process for concurrent searchd calls (excerpt chunks)
 APPHOST = 'techu.local'
 CACHE_LOCK_TIMEOUT = 10
+STATS = True # Keep cache & lock statistics in process (served by /stats)
+CACHE_INVALIDATE_BATCH = 1000 # Keys per SSCAN step & pipeline when an index version is invalidated
+CACHE_COMPRESS_THRESHOLD = 1024 # Entries larger than this (bytes) are stored zlib-compressed (0 disables)
+CACHE_COMPRESS_LEVEL = 1 # zlib level 1 (fastest) - 9 (smallest)
 SEARCH_CACHE_EXPIRE = 120.
+SEARCH_ENGINE = 'sphinxql' # 'sphinxql' (mysql41 listener) or 'native' (binary API), may be passed per request with "engine"
+SEARCH_ENGINE_INDEX = {} # Per index id overrides of SEARCH_ENGINE e.g. { 3 : 'native' }
+SPHINXQL_TEMPLATE_CACHE_SIZE = 1024 # SphinxQL statement templates memoized per query shape, per worker
+SEARCH_CACHE_STALE = 0. # Seconds a previous-version search entry may be served while refreshed (0 disables)
+SEARCH_CACHE_STALE_INDEX = {} # Per index id overrides of SEARCH_CACHE_STALE e.g. { 3 : 5. }
+SEARCH_CACHE_WINDOW = 0 # Rows fetched & cached per window of consecutive pages (0 disables), may be passed per request with "window"
+SEARCH_CACHE_WINDOW_MAX = 1000 # Upper bound of window sizes, windows never reach past this row (searchd default max_matches)
+FACET_LIMIT = 20 # Values returned per facet unless "limit" is passed in the facet spec
+SCATTER_GATHER = False # Query the shards of distributed indexes in parallel from Techu (native engine only)
+SCATTER_GATHER_INDEX = {} # Per index id overrides of SCATTER_GATHER e.g. { 3 : True }
+SCATTER_GATHER_TIMEOUT = 2. # Seconds to wait for each shard once its query started, slower shards are left out of a partial response
+SCATTER_GATHER_THREADS = 32 # Worker threads per process dedicated to shard queries
+L1_CACHE = True # In-process cache of result entries in front of Redis
+L1_CACHE_MAX_BYTES = 32 * 1024 * 1024 # Per worker
+L1_CACHE_EXPIRE = 10. # Seconds to keep entries read from Redis
+L1_CACHE_VERSION_TTL = 5. # Seconds to trust in-process index versions (updated through Pub/Sub)
+TOPOLOGY_CHECK_INTERVAL = 1. # Seconds between checks of the configuration version in Redis
+''' Sphinx mysql41 connection pool (per searchd host & port, per worker) '''
+SPHINX_POOL_SIZE = 8
+SPHINX_POOL_TIMEOUT = 5. # Seconds to wait for a free connection
+SPHINX_POOL_PING = 30. # Ping connections idle for longer than this before reuse
+SPHINX_POOL_MAX_IDLE = 240. # Close connections idle for longer than this (keep below searchd client_timeout)
+''' Persistent SphinxClient (binary API) pool, per searchd host & port, per worker '''
+SPHINX_CLIENT_POOL_SIZE = 8
+SPHINX_CLIENT_TIMEOUT = 1. # Connect timeout in seconds
+SPHINX_CLIENT_MAX_IDLE = 60. # Close persistent connections idle for longer than this
 ''' Redis '''
 REDIS_PORT = 6379
 REDIS_HOST = 'localhost'
 REDIS_PASSWORD = None
+REDIS_SOCKET = None # Unix socket path e.g. '/var/run/redis/redis.sock', used instead of host & port
+REDIS_POOL_SIZE = 32 # Connections per worker, shared by all requests (blocking waits & Pub/Sub hold one each)
+REDIS_POOL_TIMEOUT = 5. # Seconds to wait for a free connection
+REDIS_KEEPALIVE = True # TCP keepalive on Redis connections
 ''' Graceful restart (thanks to https://github.com/andreiko/django_graceful) '''
 GRACEFUL_STATEDIR = '/home/techu-search-server/run/'
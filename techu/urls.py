@@ -13,8 +13,10 @@ urlpatterns = patterns('techu.views',
   url(r'^index/list[/]*$', 'index_list', name = 'index_list'),
   url(r'^indexer/(?P<action>[a-z]+)/(?P<index_id>\d+)[/]*$', 'indexer', name = 'indexer'),
   url(r'^indexer/(?P<action>[a-z]+)/(?P<index_id>\d+)[/]*(?P<doc_id>\d+)[/]*$', 'indexer', name = 'indexer'),
+  url(r'^search/multi/(?P<index_id>\d+)[/]*$', 'search_multi', name = 'search_multi'),
   url(r'^search/(?P<index_id>\d+)[/]*$', 'search', name = 'search'),
   url(r'^excerpts/(?P<index_id>\d+)[/]*$', 'excerpts', name = 'excerpts'),
+  url(r'^stats[/]*$', 'stats', name = 'stats'),
   url(r'^generate/(?P<configuration_id>\d+)[/]*$', 'generate', name = 'generate'),
   url(r'^batch/(?P<action>[a-z]+)/(?P<index_id>\d+)[/]*$', 'batch_indexer', name = 'batch_indexer'),
   url(r'^[/]*$', 'home', name = 'home'),
@@ -1,7 +1,11 @@
 import os, sys, datetime, codecs
 import json, time, math
-import string, hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import string, hashlib, base64
 import marshal
+import logging
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.db import IntegrityError, DatabaseError
@@ -11,10 +15,17 @@ from django.core import serializers
 from libraries.generic import *
 from techu.models import *
 from libraries.sphinxapi import *
-from libraries.caching import Cache
+from libraries.caching import Cache, CacheLockTimeout
+from libraries.topology import topology
+from libraries.pool import sphinx_connection, sphinx_client, shard_client
+from libraries.stats import stats as cache_stats
+from libraries.sphinxql import compiler, identifier, direction, keyset, CURSOR_ALIAS, SEARCH_OPTIONS, SPHINXQL_OPTIONS, ORDER_DIRECTION
 import settings 
 
 modules = None
+thread_pool = None
+scatter_pool = None
+thread_pool_lock = threading.Lock()
 
 def _import(module_list):
   ''' 
@@ -46,7 +57,7 @@ def _response(data, code = 200, serialize = True):
   r.status_code = code
   if serialize:
     is_object = isinstance(data, models.query.QuerySet)
-    if isinstance(data, models.query.QuerySet) or (isinstance(data, list) and (isinstance(data[0], models.query.QuerySet))):
+    if isinstance(data, models.query.QuerySet) or (isinstance(data, list) and data and (isinstance(data[0], models.query.QuerySet))):
       data = serializers.serialize('json', data)
     else:
       data = json.dumps(data)
@@ -99,6 +110,7 @@ def option(request, section, section_instance_id):
               value = value,
               value_hash = value_hash)
       options_stored.append(o.id)
+  topology.touch()
   if section == 'searchd':    
     options_stored = SearchdOption.objects.filter(id__in = options_stored)
   elif section == 'index':    
@@ -120,6 +132,7 @@ def index(request, index_id = 0):
     except IntegrityError as e:
       Index.objects.filter(name = fields['name']).update(**fields)
       i = Index.objects.get(name = fields['name'])
+    topology.touch()
   else:
     try:
       i = Index.objects.get(pk = index_id)
@@ -147,6 +160,7 @@ def searchd(request, searchd_id = 0):
     s = Searchd.objects.filter(pk = searchd_id)
   if 'conf_id' in r:
     cs = ConfigurationSearchd.objects.create(sp_configuration_id = int(r['conf_id']), sp_searchd_id = searchd_id)
+    topology.touch()
   return _response(s)
 
 def configuration(request, conf_id = 0):
@@ -184,6 +198,12 @@ def batch_indexer(request, action, index_id):
     return _error(message = 'Invalid JSON document passed with "data" parameter')
   if not isinstance(data, list):
     data = [data]
+  ''' field names of the first document are pasted into the INSERT / UPDATE statements '''
+  try:
+    if data:
+      map(identifier, data[0].keys())
+  except Exception as e:
+    return _error(message = str(e))
   responses = []
   if action == 'insert':
     values = []
@@ -212,6 +232,11 @@ def indexer(request, action, index_id, doc_id = 0):
     data = json.loads(r['data'])
     if 'id' in data and doc_id == 0:
       doc_id = int(data['id'])
+    ''' field names are pasted into the INSERT / UPDATE statements '''
+    try:
+      map(identifier, data.keys())
+    except Exception as e:
+      return _error(message = str(e))
   queue = False  
   if 'queue' in r:
     queue = (int(r['queue']) == 1)
@@ -261,6 +286,7 @@ def modify_index(index_id, sql, queue, values = None, retries = 0):
   If either Redis or searchd is unresponsive MAX_RETRIES attempts will be performed 
   in order to store the request to the alternative
   '''
+  index_id = int(index_id)
   if retries > settings.MAX_RETRIES: 
     return _error(message = 'Maximum retries %d exceeded' % MAX_RETRIES)
   queue_action = None
@@ -274,18 +300,23 @@ def modify_index(index_id, sql, queue, values = None, retries = 0):
   cache = Cache()
   if not queue:
     try:
-      c = connections['sphinx:' + index]
-      cursor = c.cursor()
-      if queue_action == 'delete':
-        cursor.execute( sql )
-      elif queue_action == 'update':
-        cursor.execute(sql, values)
-      elif queue_action == 'insert':
-        cursor.executemany(sql, values)
+      with sphinx_connection(index_id) as c:
+        cursor = c.cursor()
+        if queue_action == 'delete':
+          cursor.execute( sql )
+        elif queue_action == 'update':
+          cursor.execute(sql, values)
+        elif queue_action == 'insert':
+          cursor.executemany(sql, values)
+    except Exception as e:
+      return modify_index(index_id, sql, True, values, retries + 1)
+    ''' only a failed write falls back to the queue, the statement must not be applied twice '''
+    try:
       cache.dirty(index_id)
-      response = { 'searchd' : 'ok' }
     except Exception as e:
-      response = modify_index(index_id, sql, True, values, retries + 1)
+      ''' the write is applied: a failure here must not make the client retry it '''
+      logging.getLogger('techu').error('Cache invalidation of index %d failed: %s' % (index_id, str(e)))
+    response = { 'searchd' : 'ok' }
   else:
     try:
       rkey = rqueue(queue_action, index_id, sql, values)
@@ -295,7 +326,10 @@ def modify_index(index_id, sql, queue, values = None, retries = 0):
   return response
 
 def fetch_index_name(index_id):
-  ''' Fetch index name by id '''
+  ''' Fetch index name by id, from the topology registry when possible '''
+  index = topology.get(index_id)
+  if not index is None:
+    return index['name']
   try:
     return Index.objects.filter(pk = index_id).values()[0]['name']
   except Exception as e:
@@ -325,201 +359,808 @@ def rqueue(queue, index_id, sql, values):
   p.execute()
   return key
 
+def _search_cache_prefix(index, data):
+  ''' Version independent cache key prefix & lock key of a search request '''
+  data_hash = hashlib.md5(index + data).hexdigest()
+  return ('cache:search:' + data_hash, 'lock:' + data_hash)
+
+def _search_cache_key(index, index_id, data, version):
+  ''' Cache & lock keys of a search request for the given index version '''
+  prefix, lock_key = _search_cache_prefix(index, data)
+  return ('%s:%d:%s' % (prefix, index_id, version), lock_key)
+
+def _unlock(cache, lock_key):
+  ''' Release a re-caching lock after a failure so that waiters do not block until it expires '''
+  try:
+    cache.unlock(lock_key)
+  except:
+    pass
+
+''' Engines serving search requests: mysql41 listener & binary API '''
+SEARCH_ENGINES = ( 'sphinxql', 'native' )
+''' Request keys shared by facet queries & name of the per group count for each engine '''
+FACET_KEYS = ( 'q', 'where', 'indexes', 'option', 'engine' )
+FACET_COUNT = { 'sphinxql' : 'facet_count', 'native' : '@count' }
+''' SPHINXQL_OPTIONS whose default has the same effect with both engines when left out '''
+CANONICAL_DEFAULTS = ( 'boolean_simplify', 'comment', 'cutoff', 'field_weights', 'global_idf',
+                       'idf', 'index_weights', 'ranker', 'reverse_scan', 'sort_method' )
+
+def _search_canonical(r):
+  '''
+  Canonical form of a parsed search request, used for its cache key so that equivalent
+  requests share entries: keys are sorted, default values dropped, sort directions
+  and where operators normalized and where conditions (AND-ed) put in a fixed order.
+  The canonical form is a valid request returning the same results.
+  '''
+  canonical = {}
+  for key, value in r.iteritems():
+    if value in ('', [], {}, None):
+      continue
+    if key == 'fields' and value in ('*', [ '*' ]):
+      continue
+    if key == 'meta':
+      if not _meta_requested(r):
+        canonical[key] = 0
+      continue
+    if key == 'q':
+      if not isinstance(value, basestring):
+        raise Exception('"q" must be a string')
+      value = value.strip()
+    elif key == 'limit' and isinstance(value, dict):
+      value = { 'offset' : int(value.get('offset', SEARCH_OPTIONS['offset'])), 
+                'count' : int(value.get('count', SEARCH_OPTIONS['limit'])) }
+      if value == { 'offset' : SEARCH_OPTIONS['offset'], 'count' : SEARCH_OPTIONS['limit'] }:
+        continue
+    elif key in ('order_by', 'order_within_group') and isinstance(value, list):
+      value = [ [ order[0], direction(order[1]) ] for order in value ]
+    elif key == 'where' and isinstance(value, dict):
+      where = {}
+      for field, conditions in value.iteritems():
+        where[field] = sorted([ [ operator.strip().upper(), sorted(operand) if isinstance(operand, list) else operand ] 
+                                for operator, operand in conditions ])
+      value = where
+    elif key == 'option' and isinstance(value, dict):
+      value = dict([ (name, option) for name, option in value.iteritems() 
+                     if not (name in SPHINXQL_OPTIONS and name in CANONICAL_DEFAULTS and str(option) == str(SPHINXQL_OPTIONS[name])) ])
+      if not value:
+        continue
+    canonical[key] = value
+  return json.dumps(canonical, sort_keys = True, separators = (',', ':'))
+
+def _meta_requested(r):
+  ''' SHOW META is returned unless the request passes "meta" : 0 '''
+  return bool(int(r.get('meta', 1)))
+
+def _search_after(r):
+  '''
+  Keyset pagination: a request passing "cursor" (true for the first page, then the
+  token returned with the previous page) is rewritten to select the rows sorted after
+  the last row of the previous page instead of skipping "offset" rows, so every page
+  costs the same to searchd. The document id is appended to the sort keys as tie-breaker.
+  An explicit "order_by" on integer attributes is required: relevance can not be resumed and
+  float attributes are returned rounded by searchd, so they can not locate the last row.
+  The sort values of the cursor are kept in "after" and selected by a keyset expression
+  (see libraries.sphinxql.keyset) whose values are bound, so every page has the same shape.
+  Returns the sort keys or None when the request is not paginated by cursor.
+  '''
+  r.pop('after', None)
+  if not r.get('cursor'):
+    return None
+  if r.get('group_by'):
+    raise Exception('Cursor pagination is not supported for grouped searches')
+  if not r.get('order_by'):
+    raise Exception('Cursor pagination requires "order_by"')
+  order = []
+  for field, direction in (r.get('order_by') or []):
+    direction = 'DESC' if str(direction).upper() in ('-1', 'DESC') else 'ASC'
+    if field != 'id':
+      order.append([ field, direction ])
+  order.append([ 'id', 'ASC' ])
+  r['order_by'] = order
+  limit = r.get('limit')
+  if not isinstance(limit, dict):
+    limit = {}
+  r['limit'] = { 'offset' : 0, 'count' : int(limit.get('count', 1000)) }
+  if r['cursor'] is True:
+    return order
+  try:
+    after = json.loads(base64.urlsafe_b64decode(str(r['cursor'])))
+  except:
+    raise Exception('Invalid cursor')
+  if after.get('order') != order:
+    raise Exception('Cursor does not match the order of the request')
+  values = after.get('values')
+  if not isinstance(values, list) or len(values) != len(order):
+    raise Exception('Invalid cursor')
+  r['after'] = { 'order' : order, 'values' : values }
+  ''' validates the sort values '''
+  keyset(r['after'], True)
+  where = r.get('where')
+  if not isinstance(where, dict):
+    where = r['where'] = {}
+  where[CURSOR_ALIAS] = [ [ '=', 1 ] ]
+  return order
+
+def _search_cursor(response, order, r):
+  ''' Add the cursor of the next page to a keyset paginated response, None after the last page '''
+  results = response['results'] or []
+  for row in results:
+    row.pop(CURSOR_ALIAS, None)
+  response['cursor'] = None
+  if len(results) < r['limit']['count'] or not results:
+    return response
+  try:
+    values = [ results[-1][field] for field, direction in order ]
+  except KeyError as e:
+    raise Exception('Sort attribute %s must be selected for cursor pagination' % str(e))
+  ''' validates the sort values '''
+  keyset({ 'order' : order, 'values' : values }, True)
+  response['cursor'] = base64.urlsafe_b64encode(json.dumps({ 'order' : order, 'values' : values }))
+  return response
+
+def _search_window(r):
+  '''
+  Windowed top-k caching: with a window size (SEARCH_CACHE_WINDOW or "window" passed
+  with the request) a page is served from the query of the aligned window of rows
+  containing it, so consecutive pages share one searchd call and one cache entry.
+  Windows hold up to SEARCH_CACHE_WINDOW_MAX rows and never reach past that row or 
+  the max_matches option of the request. "window" is removed from the request.
+  Returns (window request, offset of the page in the window, page size) 
+  or None when the page is not windowed.
+  '''
+  size = int(r.pop('window', settings.SEARCH_CACHE_WINDOW))
+  if size <= 0 or not settings.SEARCH_CACHE or r.get('cursor'):
+    return None
+  size = min(size, settings.SEARCH_CACHE_WINDOW_MAX)
+  option = r.get('option')
+  if not isinstance(option, dict):
+    option = {}
+  rows = min(int(option.get('max_matches') or settings.SEARCH_CACHE_WINDOW_MAX), settings.SEARCH_CACHE_WINDOW_MAX)
+  limit = r.get('limit')
+  if not isinstance(limit, dict):
+    limit = {}
+  offset = int(limit.get('offset', SEARCH_OPTIONS['offset']))
+  count = int(limit.get('count', SEARCH_OPTIONS['limit']))
+  start = (offset // size) * size
+  if offset + count > start + size or start + size > rows:
+    return None
+  window = dict(r)
+  window['limit'] = { 'offset' : start, 'count' : size }
+  return (window, offset - start, count)
+
+def _search_page(response, window):
+  ''' Slice the page requested out of a window response (see _search_window()) '''
+  if window is None:
+    return response
+  offset, count = window[1:]
+  page = dict(response)
+  page['results'] = (response['results'] or [])[offset:offset + count]
+  return page
+
+def _search_facets(index_id, r):
+  '''
+  Facet queries of a search request passing 
+  "facets" : [ { "attr" : "brand_id", "limit" : 20, "sort" : "count" | "value" }, ... ]
+  Every facet is a GROUP BY query on the attribute with the full-text query, filters, 
+  indexes and options of the request. The facet spec is removed from the request.
+  Returns [ (attribute, facet query) ].
+  '''
+  specs = r.pop('facets', None)
+  if not isinstance(specs, list):
+    return []
+  count = FACET_COUNT[_search_engine(index_id, r)]
+  facets = []
+  for spec in specs:
+    if isinstance(spec, basestring):
+      spec = { 'attr' : spec }
+    attr = spec['attr']
+    query = dict([ (key, value) for key, value in r.iteritems() if key in FACET_KEYS ])
+    query['group_by'] = attr
+    query['limit'] = { 'offset' : 0, 'count' : int(spec.get('limit', settings.FACET_LIMIT)) }
+    query['meta'] = 0
+    if spec.get('sort', 'count') == 'value':
+      query['order_by'] = [ [ attr, 'ASC' ] ]
+    else:
+      query['order_by'] = [ [ count, 'DESC' ], [ attr, 'ASC' ] ]
+    if count != '@count':
+      query['fields'] = [ attr, 'COUNT(*) AS ' + count ]
+    facets.append((attr, query))
+  return facets
+
+def _facet_response(facets, responses):
+  ''' { attribute : [ { "value" : ..., "count" : ... } ] } from the results of the facet queries '''
+  response = {}
+  for (attr, query), result in zip(facets, responses):
+    response[attr] = [ { 'value' : row.get(attr), 'count' : row.get('facet_count', row.get('@count')) } 
+                       for row in result['results'] or [] ]
+  return response
+
+def _engine(name):
+  ''' Return a search engine name, raise if it is neither "sphinxql" nor "native" '''
+  if not name in SEARCH_ENGINES:
+    raise Exception('Unknown search engine "%s", valid engines are [ sphinxql, native ]' % (name,))
+  return name
+
+def _search_engine(index_id, r):
+  ''' Engine serving a search request, "sphinxql" (mysql41 listener) or "native" (binary API) '''
+  return _engine(r.get('engine', settings.SEARCH_ENGINE_INDEX.get(index_id, settings.SEARCH_ENGINE)))
+
+def _utf8(s):
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return str(s)
+
+def _native_query(cl, index, r):
+  ''' 
+  Translate a JSON search request to native API calls and add it to the batch of the client.
+  Accepts the same request format as the SphinxQL compiler (libraries.sphinxql).
+  '''
+  rankers = {
+    'proximity_bm25' : SPH_RANK_PROXIMITY_BM25,
+    'bm25'           : SPH_RANK_BM25,
+    'none'           : SPH_RANK_NONE,
+    'wordcount'      : SPH_RANK_WORDCOUNT,
+    'proximity'      : SPH_RANK_PROXIMITY,
+    'matchany'       : SPH_RANK_MATCHANY,
+    'fieldmask'      : SPH_RANK_FIELDMASK,
+    'sph04'          : SPH_RANK_SPH04,
+  }
+  int_min, int_max = -2**32 + 1, 2**32 - 1
+  float_min, float_max = -3.4e38, 3.4e38
+  option = r.get('option')
+  if not isinstance(option, dict):
+    option = {}
+  ranker = option.get('ranker', 'proximity_bm25')
+  if not ranker in rankers:
+    raise Exception('Ranker "%s" is not supported by the native engine' % (ranker,))
+  cl.SetMatchMode(SPH_MATCH_EXTENDED2)
+  cl.SetRankingMode(rankers[ranker])
+  fields = r.get('fields')
+  if not isinstance(fields, list):
+    fields = [ '*' ]
+  if r.get('after'):
+    ''' the native API has no bound values, the cursor values are pasted (validated numbers) '''
+    fields = fields + [ keyset(r['after'], True) ]
+  cl.SetSelect(_utf8(',' . join(fields)))
+  limit = r.get('limit')
+  if not isinstance(limit, dict):
+    limit = {}
+  offset = int(limit.get('offset', 0))
+  count = int(limit.get('count', 1000))
+  cl.SetLimits(offset, count, int(option.get('max_matches', max(1000, offset + count))), int(option.get('cutoff', 0)))
+  order_by = ',' . join([ '%s %s' % (order[0], direction(order[1])) for order in (r.get('order_by') or []) ])
+  group_by = r.get('group_by')
+  if group_by:
+    ''' grouped: ORDER BY sorts the groups, WITHIN GROUP ORDER BY the matches in each group '''
+    within = ',' . join([ '%s %s' % (order[0], direction(order[1])) for order in (r.get('order_within_group') or []) ])
+    cl.SetGroupBy(_utf8(group_by), SPH_GROUPBY_ATTR, _utf8(order_by or '@group desc'))
+    order_by = within
+  if order_by:
+    cl.SetSortMode(SPH_SORT_EXTENDED, _utf8(order_by))
+  else:
+    cl.SetSortMode(SPH_SORT_RELEVANCE)
+  where = r.get('where')
+  if isinstance(where, dict):
+    for field, conditions in where.iteritems():
+      field = _utf8(field)
+      for operator, value in conditions:
+        operator = operator.strip().upper()
+        if operator == 'IN' or (operator == '=' and isinstance(value, (int, long, list))):
+          if not isinstance(value, list):
+            value = [ value ]
+          cl.SetFilter(field, value)
+        elif operator in ('!=', '<>', 'NOT IN') and isinstance(value, (int, long, list)):
+          if not isinstance(value, list):
+            value = [ value ]
+          cl.SetFilter(field, value, 1)
+        elif isinstance(value, float) or operator == '=':
+          value = float(value)
+          bounds = {
+            '='  : (value, value),
+            '>=' : (value, float_max),
+            '>'  : (value, float_max),
+            '<=' : (float_min, value),
+            '<'  : (float_min, value),
+          }
+          if not operator in bounds:
+            raise Exception('Operator "%s" is not supported by the native engine' % operator)
+          cl.SetFilterFloatRange(field, bounds[operator][0], bounds[operator][1], 0)
+          if operator in ('>', '<'):
+            cl.SetFilterFloatRange(field, value, value, 1)
+        else:
+          value = int(value)
+          bounds = {
+            '>=' : (value, int_max),
+            '>'  : (value + 1, int_max),
+            '<=' : (int_min, value),
+            '<'  : (int_min, value - 1),
+          }
+          if not operator in bounds:
+            raise Exception('Operator "%s" is not supported by the native engine' % operator)
+          cl.SetFilterRange(field, bounds[operator][0], bounds[operator][1])
+  if 'max_query_time' in option:
+    cl.SetMaxQueryTime(int(option['max_query_time']))
+  if 'retry_count' in option:
+    cl.SetRetries(int(option['retry_count']), int(option.get('retry_delay', 0)))
+  if isinstance(option.get('field_weights'), dict):
+    cl.SetFieldWeights(dict([ (_utf8(k), int(v)) for k, v in option['field_weights'].iteritems() ]))
+  if isinstance(option.get('index_weights'), dict):
+    cl.SetIndexWeights(dict([ (_utf8(k), int(v)) for k, v in option['index_weights'].iteritems() ]))
+  for flag in ('reverse_scan', 'sort_method', 'boolean_simplify', 'idf'):
+    if flag in option:
+      cl.SetQueryFlag(flag, _utf8(option[flag]) if isinstance(option[flag], basestring) else option[flag])
+  indexes = [ index ]
+  if isinstance(r.get('indexes'), list):
+    indexes += r['indexes']
+  cl.AddQuery(r.get('q', ''), _utf8(',' . join(indexes)), _utf8(option.get('comment', '')))
+  ''' settings that are not explicitly set per query must not leak into the next one '''
+  cl.ResetFilters()
+  cl.ResetGroupBy()
+  cl.ResetQueryFlag()
+  cl.SetFieldWeights({})
+  cl.SetIndexWeights({})
+  cl.SetMaxQueryTime(0)
+  cl.SetRetries(0, 0)
+
+def _native_response(result, meta = True):
+  ''' Convert a native API result set to the response format of the SphinxQL engine '''
+  if result is None:
+    raise Exception('Sphinx Search Query failed')
+  if result['status'] == SEARCHD_ERROR:
+    raise Exception('Sphinx Search Query failed with error "%s"' % result['error'])
+  response = { 'results' : [], 'meta' : None }
+  for match in result['matches']:
+    row = { 'id' : match['id'], 'weight' : match['weight'] }
+    row.update(match['attrs'])
+    response['results'].append(row)
+  if meta:
+    response['meta'] = [ 
+      { 'Variable_name' : 'total', 'Value' : str(result['total']) },
+      { 'Variable_name' : 'total_found', 'Value' : str(result['total_found']) },
+      { 'Variable_name' : 'time', 'Value' : result['time'] },
+    ]
+    for n, word in enumerate(result['words']):
+      response['meta'] += [
+        { 'Variable_name' : 'keyword[%d]' % n, 'Value' : word['word'] },
+        { 'Variable_name' : 'docs[%d]' % n, 'Value' : str(word['docs']) },
+        { 'Variable_name' : 'hits[%d]' % n, 'Value' : str(word['hits']) },
+      ]
+  return response
+
+def _scatter_shards(index_id, r):
+  '''
+  Shards to query in parallel for a request, None unless scatter-gather applies.
+  Indexes with an agent that can not be reached from here are left to their searchd.
+  '''
+  if not settings.SCATTER_GATHER_INDEX.get(index_id, settings.SCATTER_GATHER) or r.get('group_by'):
+    return None
+  entry = topology.get(index_id)
+  if entry is None or not entry['shards'] or entry.get('unresolved'):
+    return None
+  return entry['shards']
+
+def _scatter_query(job):
+  ''' Run a request on one shard, returns (native result, error message) '''
+  shard, r, started = job
+  started['at'] = time.time()
+  started['event'].set()
+  try:
+    with shard_client(shard) as cl:
+      _native_query(cl, _utf8(shard['index']), r)
+      results = cl.RunQueries()
+      if results is None:
+        return (None, cl.GetLastError())
+    if results[0]['status'] == SEARCHD_ERROR:
+      return (None, results[0]['error'])
+    return (results[0], None)
+  except Exception as e:
+    return (None, str(e))
+
+def _scatter_merge(results, r):
+  '''
+  Merge the results of the shards of a request: top-k matches by the requested order
+  (relevance when none), totals & keyword statistics summed, time of the slowest shard.
+  '''
+  merged = { 'status' : SEARCHD_OK, 'matches' : [], 'total' : 0, 'total_found' : 0, 'time' : 0., 'words' : [] }
+  for result in results:
+    merged['matches'] += result['matches']
+    merged['total'] += result['total']
+    merged['total_found'] += result['total_found']
+    merged['time'] = max(merged['time'], float(result['time']))
+    for n, word in enumerate(result['words']):
+      if n < len(merged['words']):
+        merged['words'][n]['docs'] += word['docs']
+        merged['words'][n]['hits'] += word['hits']
+      else:
+        merged['words'].append(dict(word))
+  order = r.get('order_by') or [ [ 'weight', 'DESC' ], [ 'id', 'ASC' ] ]
+  value = lambda match, field: match[field] if field in ('id', 'weight') else match['attrs'].get(field)
+  ''' stable sorts from the last sort key to the first '''
+  for field, direction in reversed(order):
+    field = str(field).lstrip('@')
+    merged['matches'].sort(key = lambda match: value(match, field), reverse = ORDER_DIRECTION[str(direction).upper()] == 'DESC')
+  limit = r.get('limit')
+  if not isinstance(limit, dict):
+    limit = {}
+  offset = int(limit.get('offset', SEARCH_OPTIONS['offset']))
+  count = int(limit.get('count', SEARCH_OPTIONS['limit']))
+  merged['matches'] = merged['matches'][offset:offset + count]
+  merged['time'] = '%.3f' % merged['time']
+  return merged
+
+def _search_scatter(index_id, r, shards):
+  '''
+  Scatter-gather: run a request on every shard of a distributed index in parallel
+  through the binary API and merge the top-k. Every shard returns its first offset + count
+  matches. Shards failing or not answering within SCATTER_GATHER_TIMEOUT seconds of the start
+  of their query are left out and the response is marked as partial.
+  Shard queries run on their own threads (SCATTER_GATHER_THREADS), time spent queued is not counted.
+  '''
+  limit = r.get('limit')
+  if not isinstance(limit, dict):
+    limit = {}
+  shard_query = dict(r)
+  shard_query.pop('indexes', None)
+  shard_query['limit'] = { 'offset' : 0, 'count' : int(limit.get('offset', SEARCH_OPTIONS['offset'])) + int(limit.get('count', SEARCH_OPTIONS['limit'])) }
+  pending = []
+  for shard in shards:
+    started = { 'event' : threading.Event() }
+    pending.append((started, _scatter_pool().apply_async(_scatter_query, ((shard, shard_query, started),))))
+  results = []
+  errors = []
+  for shard, (started, job) in zip(shards, pending):
+    started['event'].wait()
+    try:
+      result, error = job.get(max(0., started['at'] + settings.SCATTER_GATHER_TIMEOUT - time.time()))
+    except multiprocessing.TimeoutError:
+      result, error = None, 'timeout'
+    if result is None:
+      errors.append('%s:%s:%s %s' % (shard['host'], shard['port'], shard['index'], error))
+    else:
+      results.append(result)
+  if not results:
+    raise Exception('Sphinx Search Query failed on every shard (%s)' % ', ' . join(errors))
+  response = _native_response(_scatter_merge(results, r), _meta_requested(r))
+  if errors:
+    response['partial'] = True
+    response['shard_errors'] = errors
+  return response
+
+def _search_native(index, index_id, r):
+  ''' Run a parsed search request through the binary API of searchd '''
+  shards = _scatter_shards(index_id, r)
+  if not shards is None:
+    return _search_scatter(index_id, r, shards)
+  with sphinx_client(index_id) as cl:
+    _native_query(cl, index, r)
+    results = cl.RunQueries()
+    if results is None:
+      raise Exception('Sphinx Search Query failed with error "%s"' % cl.GetLastError())
+  return _native_response(results[0], _meta_requested(r))
+
+def _search_execute(index, index_id, r):
+  ''' Run a parsed search request against searchd and return the response dictionary '''
+  order = _search_after(r)
+  if _search_engine(index_id, r) == 'native':
+    response = _search_native(index, index_id, r)
+  else:
+    response = _search_sphinxql(index, index_id, r)
+  if not order is None:
+    _search_cursor(response, order, r)
+  return response
+
+def _search_sphinxql(index, index_id, r):
+  ''' Run a parsed search request through the mysql41 interface of searchd '''
+  sql, value_list = compiler.compile(index, r)
+  ''' SHOW META travels in the same multi-statement batch unless "meta" is disabled '''
+  meta = _meta_requested(r)
+  if meta:
+    sql += ';SHOW META'
+  response = { 'results' : None, 'meta' : None }
+  try:    
+    with sphinx_connection(index_id, True) as c:
+      cursor = c.cursor()
+      cursor.execute(sql, value_list)
+      response['results'] = cursorfetchall(cursor)
+      if meta:
+        cursor.nextset()
+        response['meta'] = cursorfetchall(cursor)
+        cursor.nextset()
+  except Exception as e:
+    error_message = 'Sphinx Search Query failed with error "%s"' % str(e)
+    raise Exception(error_message)
+  return response
+
+def _search_refresh(cache, index, index_id, data, cache_key, lock_key):
+  ''' Rebuild a search cache entry in the background, the session cache must hold lock_key '''
+  try:
+    response = _search_execute(index, index_id, json.loads(data))
+    if response.get('partial'):
+      _unlock(cache, lock_key)
+    else:
+      cache.set(cache_key, response, True, settings.SEARCH_CACHE_EXPIRE, lock_key)
+  except:
+    _unlock(cache, lock_key)
+
+def _search_stale(cache, index, index_id, data, version, cache_key, lock_key):
+  '''
+  Stale-while-revalidate: after a version bump, serve the entry cached for the previous 
+  version of the index (marked as stale) for up to SEARCH_CACHE_STALE seconds, 
+  while a single session refreshes the current entry in the background.
+  '''
+  stale = cache.stale_time(index_id)
+  if stale <= 0 or version is None:
+    return None
+  ''' versions are modification times in microseconds '''
+  if (time.time() - int(version) / 10.**6) > stale:
+    return None
+  previous = cache.previous_version(index_id)
+  if previous is None:
+    return None
+  response = cache.get(_search_cache_key(index, index_id, data, previous)[0])
+  if response is None:
+    return None
+  if cache.lock(lock_key, settings.CACHE_LOCK_TIMEOUT):
+    refresh = threading.Thread(target = _search_refresh, args = (cache, index, index_id, data, cache_key, lock_key))
+    refresh.daemon = True
+    refresh.start()
+  response['stale'] = True
+  cache_stats.incr('cache_stale', index_id)
+  return response
+
 def search(request, index_id):
+  ''' Search wrapper with SphinxQL '''
+  index_id = int(index_id)
   cache = Cache()
   index = fetch_index_name(index_id)
-  ''' Search wrapper with SphinxQL '''
   r = request_data(request)
   if 'data' in r:
     r = r['data']
+  try:
+    r = json.loads(r)
+  except:
+    return _error(message = 'Invalid JSON document passed with "data" parameter')
+  try:
+    ''' the engine serving the request is part of its cache key '''
+    r['engine'] = _search_engine(index_id, r)
+    facets = _search_facets(index_id, r)
+    ''' pages inside a window are served from the cached window query '''
+    window = _search_window(r)
+    if not window is None:
+      r = window[0]
+    if not facets:
+      r = _search_canonical(r)
+  except Exception as e:
+    return _error(message = 'Invalid search request: %s' % str(e))
+  if facets:
+    ''' the main query and the facet queries share one batch and are cached separately '''
+    try:
+      responses = _search_batch(cache, index, index_id, [ r ] + [ facet[1] for facet in facets ], r['engine'], True)
+    except Exception as e:
+      return _error(message = str(e))
+    response = responses[0]
+    response['facets'] = _facet_response(facets, responses[1:])
+    return _response(_search_page(response, window))
   if settings.SEARCH_CACHE:
-    cache_key = hashlib.md5(index + r).hexdigest()
-    lock_key = 'lock:' + cache_key
-    version = cache.version(index_id)
-    cache_key = 'cache:search:%s:%d:%s' % (cache_key, index_id, version)
+    prefix, lock_key = _search_cache_prefix(index, r)
+    ''' index version, entry and lock state in one round trip '''
+    version, cache_keys, responses, locked = cache.lookup(index_id, [ prefix ], lock_key)
+    cache_key = cache_keys[0]
     try:   
-      response = cache.get(cache_key) 
+      response = responses[0]
+      if response is None:
+        response = _search_stale(cache, index, index_id, r, version, cache_key, lock_key)
+      if response is None:
+        ''' a miss acquires the lock of this key for re-caching, concurrent misses wait for it '''
+        response = cache.fetch(cache_key, lock_key, settings.CACHE_LOCK_TIMEOUT, locked)
       if not response is None:
-        return _response(response, 200, False)
-      else:
-        ''' lock this key for re-caching '''
-        start = time.time()
-        lock = cache.get(lock_key)
-        while ( not lock is None ):
-          lock = cache.get(lock_key)
-          if (time.time() - start) > settings.CACHE_LOCK_TIMEOUT:
-            return _error(message = 'Cache lock wait timeout exceeded')
-        ''' check if key now exists in cache '''
-        response = cache.get(cache_key)
-        if not response is None:
-          return _response(response, 200, False)
-        ''' otherwise acquire lock for this session '''
-        cache.set(lock_key, 1, True, settings.CACHE_LOCK_TIMEOUT) # expire in 10sec        
+        return _response(_search_page(response, window))
+    except CacheLockTimeout as e:
+      return _error(message = str(e))
     except:
       pass    
   
-  r = json.loads(r)  
-  option_mapping = {
-    'mode' : {
-        'extended' : SPH_MATCH_EXTENDED2,
-        'boolean'  : SPH_MATCH_BOOLEAN,
-        'all'      : SPH_MATCH_ALL,
-        'phrase'   : SPH_MATCH_PHRASE,
-        'fullscan' : SPH_MATCH_FULLSCAN,
-        'any'      : SPH_MATCH_ANY,
-      }
-  }
-  options = {
-      'sortby'      : '',
-      'mode'        : 'extended',
-      'groupby'     : '',
-      'groupsort'   : '',
-      'offset'      : 0,
-      'limit'       : 1000,
-      'max_matches' : 0,
-      'cutoff'      : 0,
-      'fields'      : '*',
-    }
-  
-  sphinxql_list_options = {
-    'ranker' : [ 'proximity_bm25', 'bm25', 'none', 'wordcount', 'proximity',
-                 'matchany', 'fieldmask', 'sph04', 'expr', 'export' ],
-    'idf' : [ 'normalized', 'plain'],
-    'sort_method'  : ['pq', 'kbuffer' ]
-  }
-  sphinxql_options = { 
-    'agent_query_timeout' : 10000,
-    'boolean_simplify' : 0,
-    'comment' : '',
-    'cutoff'  : 0,
-    'field_weights' : '',
-    'global_idf' : '',
-    'idf' : 'normalized',
-    'index_weights'  : '',
-    'max_matches' : 10000,
-    'max_query_time' : 10000,
-    'ranker' : 'proximity_bm25',
-    'retry_count' : 2,
-    'retry_delay' : 100,
-    'reverse_scan' : 0,
-    'sort_method'  : 'pq'
-  }
-  order_direction = {
-    '-1'   : 'DESC',
-    'DESC' : 'DESC',
-    '1'    : 'ASC',
-    'ASC'  : 'ASC',
-  }
+  try:
+    response = _search_execute(index, index_id, json.loads(r))
+    if settings.SEARCH_CACHE:
+      ''' partial scatter-gather responses are not cached '''
+      if response.get('partial'):
+        _unlock(cache, lock_key)
+      else:
+        cache.set(cache_key, response, True, settings.SEARCH_CACHE_EXPIRE, lock_key)
+  except Exception as e:
+    if settings.SEARCH_CACHE:
+      _unlock(cache, lock_key)
+    return _error(message = str(e))
+  return _response(_search_page(response, window))
 
+def _search_batch(cache, index, index_id, queries, engine, stale = False):
+  '''
+  Run a batch of parsed search requests in a single searchd round trip per engine.
+  Every query is looked up in the cache first and only the misses
+  are sent to searchd, as one multi-statement SphinxQL batch and/or
+  one RunQueries() call for the queries served by the native engine.
+  Concurrent batches missing the same queries run them once, under a lock on the missing
+  cache keys; with stale set a miss of the first query may be served stale (see _search_stale()).
+  Queries without "engine" use the engine passed, which is recorded in their cache key.
+  Returns the responses in the order of the queries.
+  '''
+  for query in queries:
+    query['engine'] = _engine(query.get('engine', engine))
+  responses = [ None ] * len(queries)
+  lock_key = None
+  if settings.SEARCH_CACHE:
+    canonical = [ _search_canonical(query) for query in queries ]
+    prefixes = [ _search_cache_prefix(index, data)[0] for data in canonical ]
+    try:
+      version, cache_keys, responses, locked = cache.lookup(index_id, prefixes)
+    except:
+      version = cache.version(index_id)
+      cache_keys = [ '%s:%d:%s' % (prefix, index_id, version) for prefix in prefixes ]
+    if stale and queries and responses[0] is None:
+      try:
+        responses[0] = _search_stale(cache, index, index_id, canonical[0], version, cache_keys[0], 
+                                     _search_cache_prefix(index, canonical[0])[1])
+      except:
+        pass
+    misses = [ n for n, response in enumerate(responses) if response is None ]
+    if misses:
+      ''' a miss acquires the lock of the missing keys, concurrent identical misses wait for it '''
+      lock_key = 'lock:batch:' + hashlib.md5(',' . join(sorted([ cache_keys[n] for n in misses ]))).hexdigest()
+      try:
+        fetched = cache.fetch_many([ cache_keys[n] for n in misses ], lock_key, settings.CACHE_LOCK_TIMEOUT, 
+                                   [ None ] * len(misses))
+        for n, response in zip(misses, fetched):
+          responses[n] = response
+        if not None in fetched:
+          lock_key = None
+      except CacheLockTimeout:
+        raise
+      except:
+        lock_key = None
+  misses = [ n for n, response in enumerate(responses) if response is None ]
+  if not misses:
+    return responses
   try:
-    ''' Check attributes from request with stored options (sp_index_option) '''
-    ''' Preload host and ports per index '''
-    ''' Support query batch (RunQueries) '''
-    '''
-    SELECT
-    select_expr [, select_expr ...]
-    FROM index [, index2 ...]
-    [WHERE where_condition]
-    [GROUP BY {col_name | expr_alias}]
-    [WITHIN GROUP ORDER BY {col_name | expr_alias} {ASC | DESC}]
-    [ORDER BY {col_name | expr_alias} {ASC | DESC} [, ...]]
-    [LIMIT [offset,] row_count]
-    [OPTION opt_name = opt_value [, ...]]
-    '''
-    sql_sequence = [ ('SELECT', 'fields'), ('FROM', 'indexes'), ('WHERE', 'where'), 
-                     ('GROUP BY', 'group_by'), ('WITHIN GROUP ORDER BY', 'order_within_group'), 
-                     ('ORDER BY', 'order_by'), ('LIMIT', 'limit'), ('OPTION', 'option') ]
-    sql = {}
-    for sql_clause, key in sql_sequence:
-      sql[key] = ''
-      if not key in r:
-        r[key] = ''
-    sql['indexes'] = index + ','.join( r['indexes'] )
-    if isinstance(r['fields'], list):
-      sql['fields'] = ',' . join(r['fields'])
-    else:
-      sql['fields'] = options['fields']
-    if r['group_by'] != '':
-      sql['group_by'] = r['groupby']
-    if not isinstance(r['limit'], dict):
-      r['limit'] = { 'offset' : '0', 'count' : options['limit'] }
-    r['limit'] = '%(offset)s, %(count)s' % r['limit']
-    sql['order_by'] = ',' . join([ '%s %s' % (order[0], order_direction(order[1].upper())) for order in r['order_by'] ])
-    if r['order_within_group'] != '':
-      sql['order_within_group'] = ',' . join([ '%s %s' % (order[0], order_direction(order[1].upper())) for order in r['order_within_group'] ])
-    sql['where'] = [] #dictionary e.g. { 'date_from' : [[ '>' , 13445454350] ] } 
+    _search_batch_execute(index, index_id, queries, responses, misses)
+  except:
+    if not lock_key is None:
+      _unlock(cache, lock_key)
+    raise
+  if settings.SEARCH_CACHE:
+    cache.mset(dict([ (cache_keys[n], responses[n]) for n in misses ]), settings.SEARCH_CACHE_EXPIRE, lock_key)
+  return responses
+
+def _search_batch_execute(index, index_id, queries, responses, misses):
+  ''' Run the missing queries of a batch (see _search_batch()), storing their responses in place '''
+  orders = {}
+  for n in misses:
+    orders[n] = _search_after(queries[n])
+  native = [ n for n in misses if queries[n]['engine'] == 'native' ]
+  sphinxql = [ n for n in misses if queries[n]['engine'] != 'native' ]
+  if native:
+    ''' the native engine batches its misses with AddQuery / RunQueries '''
+    with sphinx_client(index_id) as cl:
+      for n in native:
+        _native_query(cl, index, queries[n])
+      results = cl.RunQueries()
+      if results is None:
+        raise Exception('Sphinx Search Query failed with error "%s"' % cl.GetLastError())
+    for n, result in zip(native, results):
+      responses[n] = _native_response(result, _meta_requested(queries[n]))
+  if sphinxql:
+    statements = []
     value_list = []
-    if isinstance(r['where'], dict):
-      for field, conditions in r['where'].iteritems():
-        for condition in conditions:
-          operator, value = condition
-          value_list.append(value)
-          sql['where'].append('%s%s%%s' % (field, operator,))
-    value_list.append(r['q'])
-    sql['where'].append('MATCH(%%s)')
-    sql['where'] = ' ' . join(sql['where'])
-    if isinstance(r['option'], dict):
-      sql['option'] = []
-      for option_name, option_value in r['option'].iteritems():
-        if isinstance(option_value, dict): 
-          option_value = '(' + (','. join([ '%s = %s' % (k, option_value[k]) for k in option_value.keys() ])) + ')'
-          sql['option'].append('%s = %s' % (option_name, option_value))
-      sql['option'] = ',' . join(sql['option'])
-    response = { 'results' : None, 'meta' : None }
-    try:    
-      cursor = connections['sphinx:' + index].cursor()
-      sql =  ' ' . join([ clause[0] + ' ' + sql[clause[1]] for clause in sql_sequence if sql[clause[1]] != '' ]) 
-      cursor.execute(sql, value_list)
-      response['results'] = cursorfetchall(cursor)
-    except Exception as e:
-      error_message = 'Sphinx Search Query failed with error "%s"' % str(e)
-      return _error(message = error_message)
+    for n in sphinxql:
+      sql, values = compiler.compile(index, queries[n])
+      statements.append(sql)
+      if _meta_requested(queries[n]):
+        statements.append('SHOW META')
+      value_list += values
     try:
-      cursor.execute('SHOW META')
-      response['meta'] = cursorfetchall(cursor)
-    except:
-      pass
-    if settings.SEARCH_CACHE:
-      cache.set(cache_key, response, True, SEARCH_CACHE_EXPIRE, lock_key)
+      with sphinx_connection(index_id, True) as c:
+        cursor = c.cursor()
+        cursor.execute(';' . join(statements), value_list)
+        for n in sphinxql:
+          response = { 'results' : cursorfetchall(cursor), 'meta' : None }
+          cursor.nextset()
+          if _meta_requested(queries[n]):
+            response['meta'] = cursorfetchall(cursor)
+            cursor.nextset()
+          responses[n] = response
+    except Exception as e:
+      raise Exception('Sphinx Search Query failed with error "%s"' % str(e))
+  for n in misses:
+    if not orders[n] is None:
+      _search_cursor(responses[n], orders[n], queries[n])
+
+def search_multi(request, index_id):
+  '''
+  Run a batch of searches (JSON array passed with "data") in a single searchd round trip
+  (see _search_batch()).
+  Returns a JSON array of responses in the order of the queries.
+  '''
+  index_id = int(index_id)
+  cache = Cache()
+  index = fetch_index_name(index_id)
+  r = request_data(request)
+  try:
+    queries = json.loads(r['data'])
+  except:
+    return _error(message = 'Invalid JSON document passed with "data" parameter')
+  if not isinstance(queries, list):
+    queries = [ queries ]
+  try:
+    responses = _search_batch(cache, index, index_id, queries, _search_engine(index_id, r))
   except Exception as e:
     return _error(message = str(e))
-  return _response(response)
+  return _response(responses)
+
+def _thread_pool():
+  ''' Process-wide worker threads for concurrent searchd calls (created again after a fork) '''
+  global thread_pool
+  pool = thread_pool
+  if pool is None or pool[0] != os.getpid():
+    with thread_pool_lock:
+      pool = thread_pool
+      if pool is None or pool[0] != os.getpid():
+        pool = thread_pool = (os.getpid(), ThreadPool(settings.SEARCHD_THREADS))
+  return pool[1]
+
+def _scatter_pool():
+  ''' Process-wide worker threads of scatter-gather shard queries (created again after a fork) '''
+  global scatter_pool
+  pool = scatter_pool
+  if pool is None or pool[0] != os.getpid():
+    with thread_pool_lock:
+      pool = scatter_pool
+      if pool is None or pool[0] != os.getpid():
+        pool = scatter_pool = (os.getpid(), ThreadPool(settings.SCATTER_GATHER_THREADS))
+  return pool[1]
+
+def _chunks(documents, size):
+  ''' Split documents in consecutive chunks of up to size bytes (at least one document each) '''
+  chunks = []
+  chunk = []
+  chunk_size = 0
+  for document in documents:
+    if chunk and chunk_size + len(document) > size:
+      chunks.append(chunk)
+      chunk = []
+      chunk_size = 0
+    chunk.append(document)
+    chunk_size += len(document)
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+def _build_excerpts(job):
+  ''' Build the snippets of one chunk of documents, returns (snippets, error message) '''
+  index_id, index, q, options, documents = job
+  try:
+    ''' searchd host & binary API port are resolved by the topology registry '''
+    with sphinx_client(index_id) as cl:
+      snippets = cl.BuildExcerpts(documents, index, q, dict(options))
+      error = cl.GetLastError()
+  except Exception as e:
+    return (None, 'Error while building excerpts ' + str(e))
+  if not snippets:
+    return (None, 'Sphinx Excerpts Error: ' + error)
+  return (snippets, None)
 
 def excerpts(request, index_id):
-  cache = Cache()
   ''' 
   --- FEATURE UNDER CONSTRUCTION ---
   Returns highlighted snippets 
-  Caches responses in Redis
+  Snippets are cached in Redis per document, keyed by index, query, options
+  and the md5 of the document, so only the documents missing from the cache
+  are sent to searchd. Concurrent requests missing the same documents build them
+  once, under a lock on the query and the missing documents.
   '''
+  index_id = int(index_id)
+  cache = Cache()
   index = fetch_index_name(index_id)
-  r = request_data(request)
-  cache_key = hashlib.md5(index + r['data']).hexdigest()
-  lock_key = 'lock:' + cache_key
-  version = cache.version(index_id)
-  cache_key = 'cache:excerpts:%s:%d:%s' % (cache_key, index_id, version)
-  if settings.EXCERPTS_CACHE:
-    try:   
-      response = cache.get(cache_key) 
-      if not response is None:
-        return _response(response, 200, False) 
-      ''' lock this key for re-caching '''
-      start = time.time()
-      lock = cache.get(lock_key)
-      while ( not lock is None ):
-        lock = cache.get(lock_key)
-        if (time.time() - start) > settings.CACHE_LOCK_TIMEOUT:
-          return _error(message = 'Cache lock wait timeout exceeded')
-      ''' check if key now exists in cache '''
-      response = cache.get(cache_key)
-      if not response is None:
-        return _response(response, 200, False)
-      ''' otherwise acquire lock for this session '''
-      cache.set(lock_key, 1, True, settings.CACHE_LOCK_TIMEOUT) # expire in 10sec         
-    except:
-      pass    
-  else:
-    r = json.loads(r['data'])
+  r = json.loads(request_data(request)['data'])
 
   options = {
       "before_match"      : '<b>',
@@ -551,7 +1192,7 @@ def excerpts(request, index_id):
   if 'ttl' in r:      
     cache_expiration = int(r['ttl'])
   else:
-    cache_expiration = settings.EXCERTS_CACHE_EXPIRE
+    cache_expiration = settings.EXCERPTS_CACHE_EXPIRE
   if isinstance(r['docs'], dict):
     document_ids = r['docs'].keys()
     documents = r['docs'].values()
@@ -564,33 +1205,67 @@ def excerpts(request, index_id):
   '''
   docs = { 838393 : 'a document with lots of text', 119996 : 'another document with text' }
   '''
-  ci = ConfigurationIndex.objects.filter(sp_index_id = index_id)
-  searchd_id = ConfigurationSearchd.objects.filter(sp_configuration_id = ci.sp_configuration_id)
-  so = SearchdOption.objects.filter(sp_searchd_id = searchd_id, sp_option_id = 138,).exclude(value__endswith = ':mysql41')
-  sphinx_port = int(so.value)
-  so = SearchdOption.objects.filter(sp_searchd_id = searchd_id, sp_option_id = 188,)
-  try:
-    sphinx_host = so.value
-  except:
-    sphinx_host = 'localhost'
-  try:
-    cl = SphinxClient()
-    cl.SetServer(host = sphinx_host, port = sphinx_port)
-    excerpts = cl.BuildExcerpts( documents, index, r['q'], options)
-    del documents
-    if not excerpts:
-      return _error(message = 'Sphinx Excerpts Error: ' + cl.GetLastError())
-    else:      
-      cache_key = ''
-      if settings.EXCERPTS_CACHE:
-        cache.set(cache_key, excerpts, True, cache_expiration, lock_key)
-      excerpts = { 
-        'excerpts' : dict(zip(document_ids, excerpts)), 
-        'cache-key' : cache_key,        
-        }
-      return _response(json.dumps(excerpts), 200, False)
-  except Exception as e:
-    return _error(message = 'Error while building excerpts ' + str(e))
+  documents = [ _utf8(document) for document in documents ]
+  snippets = [ None ] * len(documents)
+  lock_key = None
+  if settings.EXCERPTS_CACHE:
+    query_hash = hashlib.md5(json.dumps([ index, r['q'], options ], sort_keys = True)).hexdigest()
+    document_hashes = [ hashlib.md5(document).hexdigest() for document in documents ]
+    prefixes = [ 'cache:excerpts:%s:%s' % (query_hash, document_hash) for document_hash in document_hashes ]
+    try:
+      version, cache_keys, snippets, locked = cache.lookup(index_id, prefixes)
+    except:
+      version = cache.version(index_id)
+      cache_keys = [ '%s:%d:%s' % (prefix, index_id, version) for prefix in prefixes ]
+    misses = [ n for n, snippet in enumerate(snippets) if snippet is None ]
+    if misses:
+      ''' the lock covers the query and the set of missing documents, concurrent identical misses wait for it '''
+      lock_key = 'lock:excerpts:%s:%d:%s' % (query_hash, index_id, 
+        hashlib.md5(',' . join(sorted(set([ document_hashes[n] for n in misses ])))).hexdigest())
+      try:
+        fetched = cache.fetch_many([ cache_keys[n] for n in misses ], lock_key, settings.CACHE_LOCK_TIMEOUT, 
+                                   [ snippets[n] for n in misses ])
+        for n, snippet in zip(misses, fetched):
+          snippets[n] = snippet
+        if not None in fetched:
+          lock_key = None
+      except CacheLockTimeout as e:
+        return _error(message = str(e))
+      except:
+        lock_key = None
+  misses = [ n for n, snippet in enumerate(snippets) if snippet is None ]
+  if misses:
+    ''' large batches are split by size and built concurrently over several pooled connections '''
+    chunks = _chunks([ documents[n] for n in misses ], settings.EXCERPTS_CHUNK_BYTES)
+    jobs = [ (index_id, _utf8(index), r['q'], options, chunk) for chunk in chunks ]
+    if len(jobs) > 1:
+      results = _thread_pool().map(_build_excerpts, jobs)
+    else:
+      results = map(_build_excerpts, jobs)
+    built = []
+    for chunk_snippets, error in results:
+      if error:
+        if not lock_key is None:
+          _unlock(cache, lock_key)
+        return _error(message = error)
+      built += chunk_snippets
+    for n, snippet in zip(misses, built):
+      snippets[n] = snippet
+    if settings.EXCERPTS_CACHE:
+      cache.mset(dict([ (cache_keys[n], snippets[n]) for n in misses ]), cache_expiration, lock_key)
+  del documents
+  return _response({ 'excerpts' : dict(zip(document_ids, snippets)) })
+
+def stats(request):
+  '''
+  Cache & lock statistics of the worker serving the request, per index id.
+  JSON by default, Prometheus text format with ?format=prometheus
+  '''
+  if request.GET.get('format') == 'prometheus':
+    response = _response(cache_stats.prometheus(), serialize = False)
+    response['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+  return _response(cache_stats.snapshot())
 
 def generate(request, configuration_id):
   ''' 
@@ -646,6 +1321,7 @@ def generate(request, configuration_id):
     started = os.system(searchd_start % params)
   except Exception as e:
     return _error('Error while restarting searchd ' + str(e))
+  topology.touch()
   response = { 
     'configuration' : configuration, 
     'stopped' : { 'command' : searchd_stop % params,  'status' : not bool(stopped) }, 